@@ -1,19 +1,37 @@
 import json
 import logging
 import os
-import re
+import threading
 import time
+import traceback
+from collections import Counter
+from collections import OrderedDict
+from collections import deque
+from collections.abc import Mapping
 from datetime import datetime
 from datetime import date
+from datetime import timedelta
+from decimal import Decimal
 from multidimensional_urlencode import urlencode
 
 import requests
 import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
+from bitrix_mirror import BitrixMirror
+from datetime_utils import parse_bitrix_datetime
 from mysql_wrapper import MySQL
+from rate_limiter import LeakyBucket
 from utilities import Cfg
-from utilities import find_dict_in_list
+from utilities import Index
+from utilities import create_changes_table
+from utilities import create_http_session
+from utilities import get_changes
+from utilities import get_changes_since
 from utilities import get_db_data
+from utilities import get_last_change_id
+from utilities import get_rows_by_ids
+from utilities import prune_changes
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -21,6 +39,8 @@ _json_file = dir_path + os.sep + '..' + os.sep + Cfg.get('btx_token_file')
 _client_id = Cfg.get('btx_client_id')
 _client_secret = Cfg.get('btx_client_secret')
 _redirect_uri = 'blabla'
+_state_file = dir_path + os.sep + '..' + os.sep + Cfg.get('btx_state_file')
+_mysql_date_format = '%Y-%m-%d %H:%M:%S'
 _main_url = 'https://praguestars.bitrix24.com/rest/METHOD'
 
 _contact_fields = 'crm.contact.fields'
@@ -43,8 +63,23 @@ _product_remove = 'crm.product.delete'
 _product_update = 'crm.product.update'
 _product_add = 'crm.product.add'
 
-with open(_json_file, 'r') as f:
-    _token = json.load(f)
+_batch = 'batch'
+# max number of commands in one batch request
+_batch_size = 50
+# number of records in a page of list methods, it is fixed by bitrix
+_page_size = 50
+# the errors after which a command can be repeated
+_transient_errors = ['QUERY_LIMIT_EXCEEDED', 'INTERNAL_SERVER_ERROR', 'OPERATION_TIME_LIMIT', 'CONNECTION_ERROR',
+                     'NO_RESULT', 'HTTP_500', 'HTTP_502', 'HTTP_503', 'HTTP_504']
+
+_session = create_http_session(Cfg.get('btx_pool_size'))
+
+# the token is read on the first request
+_token = None
+_token_lock = threading.Lock()
+
+# bitrix24 allows 2 requests per second after a burst of 50 requests
+_rate_limiter = LeakyBucket(Cfg.get('btx_rate_limit'), Cfg.get('btx_burst_limit'))
 
 
 def json_serial(obj):
@@ -52,6 +87,9 @@ def json_serial(obj):
 
     if isinstance(obj, datetime) or isinstance(obj, date):
         return str(obj)
+    elif isinstance(obj, Decimal):
+        # bitrix lists money fields as strings as well
+        return str(obj)
     raise TypeError("Type %s not serializable" % type(obj))
 
 
@@ -65,9 +103,26 @@ class STAGE:
     ANALYZE_FAILURE = 'APOLOGY'
 
 
-def update_token():
+def get_token():
+    global _token
+    if _token is None:
+        with open(_json_file, 'r') as f:
+            _token = json.load(f)
+    return _token
+
+
+def update_token(expired_token=None):
+    with _token_lock:
+        # the token may be already refreshed by another thread
+        if expired_token is not None and get_token()['access_token'] != expired_token:
+            return
+        refresh_token()
+
+
+def refresh_token():
     global _token
-    req = requests.post('https://praguestars.bitrix24.com/oauth/token',
+    get_token()
+    req = _session.post('https://praguestars.bitrix24.com/oauth/token',
                         params={'client_id': _client_id,
                                 'client_secret': _client_secret,
                                 'refresh_token': _token[
@@ -84,94 +139,448 @@ def update_token():
 headers = {'content-type': 'application/json', 'charset': 'UTF-8'}
 
 
-def bitrix_request(method, params, rec=True, post=True):
+def bitrix_request(method, params, post=True, idempotent=True):
+    """Requests the method, the request is retried on QUERY_LIMIT_EXCEEDED, server and connection errors.
+
+    A request which is not idempotent, e.g. an add, is retried only if it surely was not processed.
+    Returns the response json, the error response if all the attempts have failed.
+    """
+
     url = _main_url.replace('METHOD', method)
-    # url = url.replace('AUTH', _token['access_token'])
-    params['auth'] = _token['access_token']
-
-    if post:
-        req = requests.post(url, data=json.dumps(params, default=json_serial), headers=headers)
-    else:
-        req = requests.get(url, params=urlencode(params))
-
-    if req.status_code == 401:
-        if rec:
-            update_token()
-            time.sleep(10)
-            return bitrix_request(method, params, rec=False)
-        else:
-            raise Exception('401 error while requesting {}'.format(url))
-    elif req.status_code == 400:
-        logging.error('Wrong data, {}'.format(req.content))
-    elif req.status_code != 200:
-        time.sleep(10)
-        if rec:
-            return bitrix_request(method, params, rec=False)
+    max_retries = Cfg.get('btx_max_retries')
+    token_refreshed = False
+    res = None
+    attempt = 0
+    while attempt <= max_retries:
+        token = get_token()['access_token']
+        params['auth'] = token
+        _rate_limiter.acquire()
+        try:
+            if post:
+                req = _session.post(url, data=json.dumps(params, default=json_serial), headers=headers)
+            else:
+                req = _session.get(url, params=urlencode(params))
+        except (requests.ConnectionError, requests.Timeout):
+            # the connection could be lost after the request was processed
+            if not idempotent or attempt == max_retries:
+                raise
+            logging.info('Connection error while requesting {}: {}'.format(url, traceback.format_exc()))
+            _rate_limiter.backoff(attempt)
+            attempt += 1
+            continue
+
+        if req.status_code == 401:
+            if token_refreshed:
+                raise Exception('401 error while requesting {}'.format(url))
+            update_token(token)
+            token_refreshed = True
+            continue
+
+        try:
+            res = req.json()
+        except ValueError:
+            res = {'error': 'HTTP_{}'.format(req.status_code), 'error_description': req.text[:200]}
+
+        if res.get('error') == 'QUERY_LIMIT_EXCEEDED':
+            # the request was rejected, so it is safe to repeat it
+            _rate_limiter.limit_exceeded()
+        elif req.status_code == 400:
+            logging.error('Wrong data, {}'.format(req.content))
+            return res
+        elif req.status_code != 200:
+            if not idempotent:
+                break
         else:
-            logging.info('{} error while requesting a {}'.format(req.status_code, url))
-            logging.info('Second try was failed, possible data loss')
+            _rate_limiter.succeeded()
+            return res
 
-    # return json.loads(req.content.decode('utf-8'))
-    return req.json()
+        if attempt < max_retries:
+            _rate_limiter.backoff(attempt)
+        attempt += 1
 
+    logging.info('{} error while requesting {}, possible data loss: {}'.format(
+        req.status_code, url, res.get('error_description', res.get('error'))))
+    return res
 
-# deal fields and mappings
-deal_fields_mapping = {}
 
-fields = bitrix_request(_deal_fields, {'select': ['UF_*']})
-for key_, val_ in fields['result'].items():
-    if str(key_).startswith('UF_CRM_') and 'formLabel' in val_:
-        deal_fields_mapping[val_['formLabel'].lower()] = key_
+def to_query_params(value):
+    # multidimensional_urlencode loses the indexes of lists and can not encode dates
+    if isinstance(value, dict):
+        return {k: to_query_params(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return {i: to_query_params(v) for i, v in enumerate(value)}
+    elif value is None:
+        return ''
+    elif isinstance(value, datetime) or isinstance(value, date):
+        return str(value)
+    return value
 
-deal_client_id_key = deal_fields_mapping['client id']
-deal_rental_id_key = deal_fields_mapping['rental id']
 
-# contact fields and mappings
-contact_fields_mapping = {}
+def encode_command(method, params):
+    # $result[...] references to the other commands of the batch are resolved by bitrix, so they are not escaped
+    refs = ['{}={}'.format(k, v) for k, v in params.items() if isinstance(v, str) and v.startswith('$result[')]
+    rest = {k: v for k, v in params.items() if not (isinstance(v, str) and v.startswith('$result['))}
+    return method + '?' + '&'.join(refs + [urlencode(to_query_params(rest))])
 
-fields = bitrix_request(_contact_fields, params={})
-for key_, val_ in fields['result'].items():
-    if str(key_).startswith('UF_CRM_') and 'formLabel' in val_:
-        contact_fields_mapping[val_['formLabel'].lower()] = key_
 
-contact_client_id_key = contact_fields_mapping['client id']
+def is_retriable(method, error):
+    # QUERY_LIMIT_EXCEEDED commands were not run, the others may be only if they are idempotent
+    code = error.get('error') if isinstance(error, dict) else None
+    if code == 'QUERY_LIMIT_EXCEEDED':
+        return True
+    return not method.endswith('.add') and code in _transient_errors
 
-# product fields and mappings
-product_fields_mapping = {}
-fields = bitrix_request(_product_fields, params={})
-for key_, val_ in fields['result'].items():
-    if str(key_).startswith('PROPERTY_') and 'title' in val_:
-        product_fields_mapping[val_['title'].lower()] = key_
 
-product_rental_id_key = product_fields_mapping['rental_id']
+def resolve_references(params, results):
+    # $result[key] of the commands succeeded in the previous batches are replaced with their results
+    resolved = {}
+    for k, v in params.items():
+        if isinstance(v, str) and v.startswith('$result[') and v[len('$result['):-1] in results:
+            v = results[v[len('$result['):-1]]
+        resolved[k] = v
+    return resolved
 
 
-def contains(deal, deals):
-    for deal2 in deals:
-        if deal['ID'] == deal2['ID']:
-            return True
-    return False
+def run_batch(batch):
+    """Sends one batch request, returns {key: result} and {key: error} of its commands."""
+
+    cmd = {key: encode_command(method, params) for key, method, params in batch}
+    idempotent = all(not method.endswith('.add') for key, method, params in batch)
+    try:
+        res = bitrix_request(_batch, params={'halt': 0, 'cmd': cmd}, idempotent=idempotent)
+    except (requests.ConnectionError, requests.Timeout):
+        logging.info('Batch request failed: {}'.format(traceback.format_exc()))
+        res = {'error': 'CONNECTION_ERROR'}
+
+    if 'result' not in res:
+        error = {'error': res.get('error'), 'error_description': res.get('error_description')}
+        return {}, {key: error for key in cmd}
+
+    # bitrix returns an empty list instead of an empty dict
+    batch_results = res['result'].get('result') or {}
+    batch_errors = res['result'].get('result_error') or {}
+    for key in cmd:
+        if key not in batch_results and key not in batch_errors:
+            batch_errors[key] = {'error': 'NO_RESULT'}
+
+    return batch_results, batch_errors
+
+
+def bitrix_batch(command_groups, description):
+    """Runs the commands with batch requests of up to 50 commands, the batches are sent in parallel.
+
+    A command is a (key, method, params) tuple, its params may reference the result of a previous command
+    by '$result[key]', so the commands of a group are always sent in the same batch.
+    The commands which failed with a transient error are retried, adds only if they surely were not run.
+    Returns {key: result} of the succeeded commands and {key: error} of the failed ones.
+    """
+
+    results = {}
+    errors = {}
+    progress_bar = tqdm.tqdm(total=sum(len(group) for group in command_groups))
+    progress_bar.set_description(description)
+
+    for attempt in range(Cfg.get('btx_max_retries') + 1):
+        batches = []
+        batch = []
+        for group in command_groups:
+            if batch and len(batch) + len(group) > _batch_size:
+                batches.append(batch)
+                batch = []
+            batch.extend(group)
+        if batch:
+            batches.append(batch)
+
+        with ThreadPoolExecutor(max_workers=Cfg.get('btx_max_workers')) as executor:
+            for batch, (batch_results, batch_errors) in zip(batches, executor.map(run_batch, batches)):
+                results.update(batch_results)
+                errors.update(batch_errors)
+                progress_bar.update(len(batch_results))
+
+        # the failed commands of each group are retried, the references to the succeeded ones are resolved
+        retry_groups = []
+        for group in command_groups:
+            retry_group = []
+            retry_keys = set()
+            for key, method, params in group:
+                # a command referencing a retried one failed because of it
+                depends = any(isinstance(v, str) and v.startswith('$result[') and v[len('$result['):-1] in retry_keys
+                              for v in params.values())
+                if key in errors and (depends or is_retriable(method, errors[key])):
+                    retry_group.append((key, method, resolve_references(params, results)))
+                    retry_keys.add(key)
+            if retry_group:
+                retry_groups.append(retry_group)
+
+        if not retry_groups or attempt == Cfg.get('btx_max_retries'):
+            break
+
+        for group in retry_groups:
+            for key, method, params in group:
+                del errors[key]
+        command_groups = retry_groups
+        logging.info('Retrying {} failed commands'.format(sum(len(group) for group in retry_groups)))
+        _rate_limiter.backoff(attempt)
+
+    progress_bar.update(len(errors))
+    return results, errors
+
+
+def fetch_field_mappings():
+    # custom fields are mapped by their labels
+    mappings = {'deal': {}, 'contact': {}, 'product': {}}
+
+    fields = bitrix_request(_deal_fields, {'select': ['UF_*']})
+    for key_, val_ in fields['result'].items():
+        if str(key_).startswith('UF_CRM_') and 'formLabel' in val_:
+            mappings['deal'][val_['formLabel'].lower()] = key_
+
+    fields = bitrix_request(_contact_fields, params={})
+    for key_, val_ in fields['result'].items():
+        if str(key_).startswith('UF_CRM_') and 'formLabel' in val_:
+            mappings['contact'][val_['formLabel'].lower()] = key_
+
+    fields = bitrix_request(_product_fields, params={})
+    for key_, val_ in fields['result'].items():
+        if str(key_).startswith('PROPERTY_') and 'title' in val_:
+            mappings['product'][val_['title'].lower()] = key_
+
+    return mappings
+
+
+class FieldMappings:
+    """Deal, contact and product field mappings {label: field key}, requested from bitrix on first use.
+
+    The mappings are cached in a json file. A fresh cache is used without any request,
+    an expired one is still used while it is refreshed in background.
+    """
+
+    def __init__(self, cache_file, ttl):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.mappings = None
+        self.lock = threading.Lock()
+        self.refresh_thread = None
 
+    def load(self):
+        with self.lock:
+            if self.mappings is not None:
+                return self.mappings
 
-def get_bitrix_data(content_type, params):
-    old_size = 0
+            cache = None
+            if os.path.exists(self.cache_file):
+                try:
+                    with open(self.cache_file, 'r') as f:
+                        cache = json.load(f)
+                except ValueError:
+                    logging.info('Field mappings cache {} is broken'.format(self.cache_file))
 
-    req = bitrix_request(content_type, params=params, post=False)
-    data = req['result']
-    if 'next' not in req:
-        return data
+            if cache:
+                self.mappings = cache['mappings']
+                if time.time() - cache['updated_at'] > self.ttl:
+                    self.refresh_thread = threading.Thread(target=self.refresh, daemon=True)
+                    self.refresh_thread.start()
+            else:
+                self.mappings = self.fetch()
 
-    while len(data) != old_size:
-        old_size = len(data)
-        params['start'] = req['next']
-        req = bitrix_request(content_type, params=params)
-        for v in req['result']:
-            if not contains(v, data):
-                data.append(v)
-        if 'next' not in req:
+        return self.mappings
+
+    def fetch(self):
+        mappings = fetch_field_mappings()
+
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(self.cache_file, 'w') as f:
+            json.dump({'updated_at': time.time(), 'mappings': mappings}, f)
+
+        return mappings
+
+    def refresh(self):
+        try:
+            self.mappings = self.fetch()
+            logging.info('Field mappings are refreshed')
+        except:
+            logging.info('Could not refresh field mappings: {}'.format(traceback.format_exc()))
+
+    @property
+    def deal(self):
+        return self.load()['deal']
+
+    @property
+    def contact(self):
+        return self.load()['contact']
+
+    @property
+    def product(self):
+        return self.load()['product']
+
+
+field_mappings = FieldMappings(dir_path + os.sep + '..' + os.sep + Cfg.get('btx_fields_cache_file'),
+                               Cfg.get('btx_fields_cache_ttl') * 3600)
+
+
+def iter_bitrix_data(content_type, params):
+    """Streams all the records of a list method.
+
+    The pages are requested by ID (order by ID, filter >ID, start -1), so bitrix neither counts the total
+    nor skips the offset rows. The records are yielded as the pages arrive.
+    """
+
+    params = dict(params)
+    params['order'] = {'ID': 'ASC'}
+    params['start'] = -1
+    list_filter = dict(params.get('filter', {}))
+
+    seen_ids = set()
+    last_id = 0
+    while True:
+        list_filter['>ID'] = last_id
+        params['filter'] = list_filter
+        res = bitrix_request(content_type, params=params)
+        if 'result' not in res:
+            # a truncated listing would make the unlisted records look missing
+            raise Exception('Could not list {}: {}'.format(content_type,
+                                                          res.get('error_description', res.get('error'))))
+        page = res['result'] or []
+
+        new_records = 0
+        for record in page:
+            record_id = int(record['ID'])
+            if record_id in seen_ids:
+                continue
+            seen_ids.add(record_id)
+            last_id = max(last_id, record_id)
+            new_records += 1
+            yield record
+
+        # a short page is the last one
+        if len(page) < _page_size or not new_records:
             break
 
-    return data
+
+def latest_modification(records, modified_field, modified_at=None):
+    for record in records:
+        value = record.get(modified_field)
+        if value and (modified_at is None or parse_bitrix_datetime(value) > parse_bitrix_datetime(modified_at)):
+            modified_at = value
+    return modified_at
+
+
+class EntityStore:
+    """Bitrix records of one entity type, loaded once per run and kept up to date with the changes sent by the run.
+
+    The records are kept by bitrix ID, external_key returns the db id stored in a record.
+    They are read from the local mirror and only the records modified since the last run are listed,
+    all of them are listed on the first run, with full_check=True and every full_check_interval seconds.
+    """
+
+    def __init__(self, name, list_method, select, modified_field, external_key):
+        self.name = name
+        self.list_method = list_method
+        self.select = select
+        self.modified_field = modified_field
+        self.external_key = external_key
+        self.full_check = False
+        self.records = None
+        self.index = None
+
+    def reset(self, full_check=False):
+        self.full_check = full_check
+        self.records = None
+        self.index = None
+
+    def load(self):
+        if self.records is None:
+            self.records = self.sync()
+        return self.records
+
+    def sync(self):
+        modified_at, full_check_at = bitrix_mirror.get_sync(self.name)
+        now = time.time()
+        if self.full_check or modified_at is None or now - full_check_at > _mirror_full_check_interval:
+            listed = list(iter_bitrix_data(self.list_method, {'select': self.select}))
+            records = OrderedDict((str(r['ID']), r) for r in listed)
+            bitrix_mirror.replace(self.name, listed)
+            full_check_at = now
+            logging.info('Bitrix {} are fully listed: {}'.format(self.name, len(listed)))
+        else:
+            # >= as several records may be modified within the same second
+            listed = list(iter_bitrix_data(self.list_method, {'select': self.select,
+                                                              'filter': {'>=' + self.modified_field: modified_at}}))
+            records = bitrix_mirror.load(self.name)
+            for record in listed:
+                records[str(record['ID'])] = record
+            bitrix_mirror.put(self.name, listed)
+            logging.info('Bitrix {} modified since {}: {}'.format(self.name, modified_at, len(listed)))
+
+        bitrix_mirror.set_sync(self.name, latest_modification(listed, self.modified_field, modified_at), full_check_at)
+        return records
+
+    def all(self):
+        return list(self.load().values())
+
+    def added(self, record, bitrix_id):
+        record = dict(record)
+        record['ID'] = str(bitrix_id)
+        self.load()[record['ID']] = record
+        bitrix_mirror.put(self.name, [record])
+        self.index = None
+
+    def updated(self, record):
+        stored = self.load().setdefault(str(record['ID']), {})
+        stored.update(record)
+        bitrix_mirror.put(self.name, [stored])
+        self.index = None
+
+    def removed(self, bitrix_id):
+        self.load().pop(str(bitrix_id), None)
+        bitrix_mirror.delete(self.name, [bitrix_id])
+        self.index = None
+
+    def external_ids(self):
+        # {external id: bitrix ID}, the last listed record wins if several have the same external id
+        if self.index is None:
+            self.index = {}
+            for record in self.load().values():
+                try:
+                    self.index[int(self.external_key(record))] = record['ID']
+                except (KeyError, ValueError, TypeError):
+                    continue
+        return self.index
+
+
+class ExternalIds(Mapping):
+    """Read only {external id: bitrix ID} view over an EntityStore."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, external_id):
+        return self.store.external_ids()[external_id]
+
+    def __iter__(self):
+        return iter(self.store.external_ids())
+
+    def __len__(self):
+        return len(self.store.external_ids())
+
+
+def property_value(value):
+    # product properties are listed as {'value': ...} but sent as plain values
+    return value['value'] if isinstance(value, dict) else value
+
+
+bitrix_mirror = BitrixMirror(dir_path + os.sep + '..' + os.sep + Cfg.get('btx_mirror_file'), json_serial)
+_mirror_full_check_interval = Cfg.get('btx_mirror_full_check') * 3600
+
+# products have no DATE_MODIFY, their modification time is TIMESTAMP_X
+contact_store = EntityStore('contacts', _contact_list, ['*', 'UF_*', 'PHONE', 'EMAIL'], 'DATE_MODIFY',
+                            lambda c: c[field_mappings.contact['client id']])
+product_store = EntityStore('products', _product_list, ['*', 'PROPERTY_*'], 'TIMESTAMP_X',
+                            lambda p: property_value(p[field_mappings.product['rental_id']]))
+deal_store = EntityStore('deals', _deal_list, ['UF_*', '*'], 'DATE_MODIFY',
+                         lambda d: d[field_mappings.deal['id booking (source)']])
 
 
 def are_differ(bookingsync_record, bitrix_record, exceptions: list):
@@ -201,8 +610,7 @@ def are_differ(bookingsync_record, bitrix_record, exceptions: list):
 
         # change btx_field data format to bks_field
         if type(bks_field) == datetime:
-            tm = re.search(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}([\+-]\d{2}:\d{2})', btx_field)
-            btx_field = datetime.strptime(btx_field, '%Y-%m-%dT%H:%M:%S{}'.format(tm.group(1)))
+            btx_field = parse_bitrix_datetime(btx_field)
 
         # compare in string format
         if str(bks_field).strip() != str(btx_field).strip():
@@ -239,104 +647,99 @@ def are_differ_products(bookingsync_record, bitrix_record):
     return False
 
 
-def prepare_contacts(new_clients):
-    bitrix_contacts = get_bitrix_data(_contact_list, params={'select': ['*', 'UF_*', 'PHONE', 'EMAIL']})
-    to_add = []
-    to_remove = []
-    to_update = []
-    for client in new_clients:
-        btx_contact = find_dict_in_list(bitrix_contacts, contact_client_id_key, client['ID'])
+def is_removed(external_id, removed_ids):
+    # in partial mode only the records of the removed db rows (a set of string ids) are removed
+    return removed_ids is None or str(external_id) in removed_ids
 
-        if btx_contact:
-            if 'PHONE' not in btx_contact:
-                btx_contact['PHONE'] = [{'VALUE': '', 'VALUE_TYPE': 'OTHER'}]
-            if 'EMAIL' not in btx_contact:
-                btx_contact['EMAIL'] = [{'VALUE': '', 'VALUE_TYPE': 'OTHER'}]
 
-            assert type(btx_contact) == dict
-            if are_differ(client, btx_contact, Cfg.get('btx_contact_mutable_fields')):
-                for i, p in enumerate(client['PHONE']):
-                    p['ID'] = btx_contact['PHONE'][i]['ID']
+def reconcile(new_records, bitrix_records, new_key, bitrix_key, merge, removed_ids=None):
+    """Matches the new records with the bitrix ones by their external id in a single pass.
 
-                for i, p in enumerate(client['EMAIL']):
-                    p['ID'] = btx_contact['EMAIL'][i]['ID']
+    new_key and bitrix_key return the external id of a new and of a bitrix record.
+    merge(new_record, bitrix_record) returns True if the bitrix record should be updated,
+    it also copies the bitrix ids into the new record.
+    Returns the records to add, the records to update and the ids of the bitrix records to remove.
+    """
 
-                client['ID'] = btx_contact['ID']
-                to_update.append(client)
+    # several bitrix records may have the same external id, they are matched in the listed order
+    bitrix_index = {}
+    for btx_record in bitrix_records:
+        bitrix_index.setdefault(Index.normalize(bitrix_key(btx_record)), deque()).append(btx_record)
 
-            bitrix_contacts.remove(btx_contact)
+    to_add = []
+    to_update = []
+    for record in new_records:
+        matched = bitrix_index.get(Index.normalize(new_key(record)))
+        if matched:
+            if merge(record, matched.popleft()):
+                to_update.append(record)
         else:
-            to_add.append(client)
+            to_add.append(record)
 
-    for old_deal in bitrix_contacts:
-        to_remove.append(old_deal['ID'])
+    to_remove = [btx_record['ID'] for matched in bitrix_index.values() for btx_record in matched
+                 if is_removed(bitrix_key(btx_record), removed_ids)]
 
     return to_add, to_update, to_remove
 
 
-def find_product_in_list(lst, key, value):
-    for dic in lst:
-        if str(dic[key]['value']) == str(value):
-            return dic
-    return None
+def merge_contact(client, btx_contact):
+    if 'PHONE' not in btx_contact:
+        btx_contact['PHONE'] = [{'VALUE': '', 'VALUE_TYPE': 'OTHER'}]
+    if 'EMAIL' not in btx_contact:
+        btx_contact['EMAIL'] = [{'VALUE': '', 'VALUE_TYPE': 'OTHER'}]
 
+    if not are_differ(client, btx_contact, Cfg.get('btx_contact_mutable_fields')):
+        return False
 
-def prepare_products(new_products):
-    bitrix_products = get_bitrix_data(_product_list, params={'select': ['*', 'PROPERTY_*']})
-    to_add = []
-    to_remove = []
-    to_update = []
-    id_key = product_rental_id_key
-    for product in new_products:
-        btx_prod = find_product_in_list(bitrix_products, id_key, product[id_key])
-        if btx_prod:
-            if are_differ_products(product, btx_prod):
-                product['ID'] = btx_prod['ID']
-                to_update.append(product)
-            bitrix_products.remove(btx_prod)
-        else:
-            to_add.append(product)
+    for i, p in enumerate(client['PHONE']):
+        p['ID'] = btx_contact['PHONE'][i]['ID']
 
-    for old_product in bitrix_products:
-        to_remove.append(old_product['ID'])
+    for i, p in enumerate(client['EMAIL']):
+        p['ID'] = btx_contact['EMAIL'][i]['ID']
 
-    return to_add, to_update, to_remove
+    client['ID'] = btx_contact['ID']
+    return True
 
 
-def prepare_deals(new_deals):
-    bitrix_deals = get_bitrix_data(_deal_list, params={'select': ['UF_*', '*']})
-    to_add = []
-    to_remove = []
-    to_update = []
-    id_key = deal_fields_mapping.get('id booking (source)')
-    for deal in new_deals:
-        btx_deal = find_dict_in_list(lst=bitrix_deals, key=id_key, value=deal[id_key])
+def merge_product(product, btx_product):
+    if not are_differ_products(product, btx_product):
+        return False
 
-        if btx_deal:
-            # a workaround for difference of precisions
-            btx_deal['OPPORTUNITY'] = None if not btx_deal['OPPORTUNITY'] else float(btx_deal['OPPORTUNITY'])
+    product['ID'] = btx_product['ID']
+    return True
 
-            if are_differ(deal, btx_deal, Cfg.get('btx_deal_mutable_fields')):
-                deal['ID'] = btx_deal['ID']
-                to_update.append(deal)
 
-            bitrix_deals.remove(btx_deal)
-        else:
-            to_add.append(deal)
+def merge_deal(deal, btx_deal):
+    # a workaround for difference of precisions
+    btx_deal['OPPORTUNITY'] = None if not btx_deal['OPPORTUNITY'] else float(btx_deal['OPPORTUNITY'])
 
-    for old_deal in bitrix_deals:
-        to_remove.append(old_deal['ID'])
+    if not are_differ(deal, btx_deal, Cfg.get('btx_deal_mutable_fields')):
+        return False
+
+    deal['ID'] = btx_deal['ID']
+    return True
+
+
+def prepare_contacts(new_clients, removed_ids=None):
+    id_key = field_mappings.contact['client id']
+    return reconcile(new_clients, contact_store.all(), lambda c: c[id_key], contact_store.external_key,
+                     merge_contact, removed_ids)
+
+
+def prepare_products(new_products, removed_ids=None):
+    id_key = field_mappings.product['rental_id']
+    return reconcile(new_products, product_store.all(), lambda p: p[id_key], product_store.external_key,
+                     merge_product, removed_ids)
 
-    return to_add, to_update, to_remove
 
+def prepare_deals(new_deals, removed_ids=None):
+    id_key = field_mappings.deal.get('id booking (source)')
+    return reconcile(new_deals, deal_store.all(), lambda d: d[id_key], deal_store.external_key, merge_deal,
+                     removed_ids)
 
-def get_returning_host(client_id, bookings):
-    n = 0
-    for b in bookings:
-        if client_id == b['client_id']:
-            n += 1
 
-    return '1' if n > 1 else '0'
+def get_returning_host(client_id, client_bookings: Counter):
+    return '1' if client_bookings[client_id] > 1 else '0'
 
 
 def get_stage(start_at, end_at, status):
@@ -364,6 +767,7 @@ def get_stage(start_at, end_at, status):
 
 def get_clients_from_db(db_data):
     contacts = []
+    cm = field_mappings.contact
     for client in db_data['clients']:
         contact = dict()
 
@@ -371,11 +775,11 @@ def get_clients_from_db(db_data):
         contact['NAME'] = client['firstname'] if client['firstname'] else ''
         contact['LAST_NAME'] = client['lastname'] if client['lastname'] else ''
         contact['SECOND_NAME'] = client['fullname'] if client['fullname'] else ''
-        contact[contact_fields_mapping['street']] = client['address1']
-        contact[contact_fields_mapping['city']] = client['city']
-        contact[contact_fields_mapping['country']] = client['country_code']
-        contact[contact_fields_mapping['state']] = client['state']
-        contact[contact_fields_mapping['prefered language']] = client['preferred_locale']
+        contact[cm['street']] = client['address1']
+        contact[cm['city']] = client['city']
+        contact[cm['country']] = client['country_code']
+        contact[cm['state']] = client['state']
+        contact[cm['prefered language']] = client['preferred_locale']
 
         mobile = client['mobile'] if client['mobile'] else client['phone'] if client['phone'] else ''
         contact['PHONE'] = [{'VALUE': '{}'.format(m), 'VALUE_TYPE': "OTHER"} for m in mobile.split(',')]
@@ -383,7 +787,7 @@ def get_clients_from_db(db_data):
         email = client['email'] if client['email'] else ''
         contact['EMAIL'] = [{'VALUE': '{}'.format(e), 'VALUE_TYPE': "OTHER"} for e in email.split(',')]
 
-        contact[contact_fields_mapping['client id']] = client['id']
+        contact[cm['client id']] = client['id']
         contact['COMMENTS'] = client['notes']
         contacts.append(contact)
 
@@ -395,7 +799,7 @@ def get_clients_from_db(db_data):
 
 def get_products_from_db(db_data):
     products = []
-    pm = product_fields_mapping
+    pm = field_mappings.product
     for rental in db_data['rentals']:
         products.append(
             {
@@ -412,28 +816,16 @@ def get_products_from_db(db_data):
     return products
 
 
-client_contact_ids = {}
+client_contact_ids = ExternalIds(contact_store)
+rental_product_ids = ExternalIds(product_store)
 
 
-def get_contact_ids():
-    contacts = get_bitrix_data(_contact_list, params={'select': ['ID', 'UF_*']})
-    for c in contacts:
-        client_contact_ids[int(c[contact_client_id_key])] = c['ID']
+def get_deals_from_db(db_data, client_bookings):
+    # the bookings are iterated once, so they can be streamed
+    dm = field_mappings.deal
 
-
-rental_product_ids = {}
-
-
-def get_product_ids():
-    product = get_bitrix_data(_product_list, params={'select': ['ID', 'PROPERTY_*']})
-    for c in product:
-        rental_product_ids[int(c[product_rental_id_key]['value'])] = c['ID']
-
-
-def get_deals_from_db(db_data):
-    global deal_fields_mapping
-    dm = deal_fields_mapping
-    get_product_ids()
+    clients = Index(db_data['clients'], 'id')
+    rentals = Index(db_data['rentals'], 'id')
 
     deals = []
     unavailable = 0
@@ -478,17 +870,17 @@ def get_deals_from_db(db_data):
         except (ValueError, TypeError):
             deal[dm['number of nights']] = None
 
-        client = find_dict_in_list(db_data['clients'], 'id', booking['client_id'])
+        client = clients.get(booking['client_id'])
         if client:
             deal[dm['client id']] = booking['client_id']
-            deal[dm['returning host']] = get_returning_host(booking['client_id'], db_data['bookings'])
+            deal[dm['returning host']] = get_returning_host(booking['client_id'], client_bookings)
             client_name = client['fullname']
         else:
             deal[dm['client id']] = None
             deal[dm['returning host']] = '0'
             client_name = 'unknown'
 
-        rental = find_dict_in_list(db_data['rentals'], 'id', booking['rental_id'])
+        rental = rentals.get(booking['rental_id'])
         if rental:
             deal[dm['rental id']] = booking['rental_id']
         rental_name = '' if not rental or 'name' not in rental else rental['name']
@@ -516,140 +908,350 @@ def get_deals_from_db(db_data):
     return deals
 
 
-def delete_bitrix_fields(remove_method, field_ids, name):
-    tq = tqdm.tqdm(total=len(field_ids))
-    tq.set_description('Removing old {}'.format(name))
-    for _id in field_ids:
-        tq.update(1)
+def is_not_found(error):
+    # the record is already deleted in bitrix
+    return 'not found' in str(error.get('error_description') or error.get('error') or '').lower()
+
+
+def failed_changes(store, records, bitrix_ids):
+    """Returns {external id: op} of the records which could not be added, updated or deleted.
+
+    They are stored in the state and processed again by the next run.
+    """
+    changes = {}
+    for record in records:
         try:
-            bitrix_request(remove_method, params={'id': _id})
-        except:
-            logging.error('Could not delete deal with id: {}'.format(_id))
+            changes[int(store.external_key(record))] = 'update'
+        except (KeyError, ValueError, TypeError):
+            continue
 
+    for _id in bitrix_ids:
+        try:
+            changes[int(store.external_key(store.load()[str(_id)]))] = 'delete'
+        except (KeyError, ValueError, TypeError):
+            continue
 
-def update_bitrix_fields(update_method, fields, name):
-    status_bar = tqdm.tqdm(total=len(fields))
-    status_bar.set_description('Updating modified {}'.format(name))
-    for field in fields:
-        status_bar.update(1)
-        # for k, v in list(field.items()):
-        # if not v:
-        #     del field[k]
-        assert 'ID' in field
-        bitrix_request(update_method, params={'id': field['ID'], 'fields': field})
+    return changes
 
 
-def add_contacts_to_deals(deal, res):
-    global rental_product_ids
-    global client_contact_ids
+def delete_bitrix_fields(remove_method, field_ids, name, store=None):
+    # returns the ids which could not be deleted
+    commands = [[('d{}'.format(i), remove_method, {'id': _id})] for i, _id in enumerate(field_ids)]
+    results, errors = bitrix_batch(commands, 'Removing old {}'.format(name))
+    failed = []
+    for i, _id in enumerate(field_ids):
+        error = errors.get('d{}'.format(i))
+        if error and not is_not_found(error):
+            failed.append(_id)
+            logging.error('Could not delete {} with id {}: {}'.format(name, _id, error))
+        elif store:
+            store.removed(_id)
 
-    if 'result' in res:
-        deal_id = res['result']
+    return failed
 
-        # bind contact to deals
-        try:
-            client_id = int(deal[deal_client_id_key])
-        except (ValueError, TypeError):
-            client_id = None
-
-        if client_id:
-            bitrix_request(_deal_add_contact,
-                           params={'id': deal_id,
-                                   'fields': {
-                                       'CONTACT_ID': client_contact_ids[client_id],
-                                       'IS_PRIMARY': 'Y'
-                                   }
-                                   })
+
+def update_bitrix_fields(update_method, fields, name, store=None):
+    # returns the records which could not be updated
+    for field in fields:
+        assert 'ID' in field
+    commands = [[('u{}'.format(i), update_method, {'id': field['ID'], 'fields': field})]
+                for i, field in enumerate(fields)]
+    results, errors = bitrix_batch(commands, 'Updating modified {}'.format(name))
+    failed = []
+    for i, field in enumerate(fields):
+        if 'u{}'.format(i) in errors:
+            failed.append(field)
+            logging.error('Could not update {} with id {}: {}'.format(name, field['ID'], errors['u{}'.format(i)]))
+        elif store:
+            store.updated(field)
+
+    return failed
+
+
+def deal_contact_commands(deal, deal_key):
+    # binds the contact to the deal added by deal_key command of the same batch
+    try:
+        client_id = int(deal[field_mappings.deal['client id']])
+    except (ValueError, TypeError):
+        client_id = None
+
+    if not client_id or client_id not in client_contact_ids:
+        logging.info('Booking {} has not client contact'.format(deal.get(field_mappings.deal['id booking (source)'])))
+        return []
+
+    return [(deal_key + '_contact', _deal_add_contact, {'id': '$result[{}]'.format(deal_key),
+                                                         'fields': {'CONTACT_ID': client_contact_ids[client_id],
+                                                                    'IS_PRIMARY': 'Y'}})]
+
+
+def add_bitrix_fields(add_method, records, name, bind_commands=None, store=None):
+    """Adds the records, bind_commands(record, key) may return the commands depending on the added record.
+
+    The ID of each added record is stored in it, the records which could not be added are returned.
+    """
+
+    commands = []
+    for i, record in enumerate(records):
+        key = 'a{}'.format(i)
+        group = [(key, add_method, {'fields': record})]
+        if bind_commands:
+            group += bind_commands(record, key)
+        commands.append(group)
+
+    results, errors = bitrix_batch(commands, 'Adding new {}'.format(name))
+    failed = []
+    for i, record in enumerate(records):
+        key = 'a{}'.format(i)
+        if key in results:
+            record['ID'] = results[key]
+            if store:
+                store.added(record, results[key])
         else:
-            logging.info('Booking {} has not client id'.find(str(res['result'])))
-
-        # bind product to deals
-        # try:
-        #     product_id = int(deal[deal_rental_id_key])
-        # except TypeError:
-        #     product_id = None
-
-        # if product_id:
-        #     bitrix_request(_deal_add_product,
-        #                    params={'id': deal_id,
-        #                            'rows': [{
-        #                                'PRODUCT_ID': rental_product_ids[int(product_id)],
-        #                                # 'SECTION_ID': Cfg.get('btx_product_section_id'),
-        #                                # 'PRICE': 123,
-        #                                # 'QUANTITY': 1
-        #                            }]
-        #                            })
-        # else:
-        #     print_std_and_log('Booking {} has not rental id'.find(str(res['result'])))
-
-
-def add_bitrix_fields(add_method, records, name, callback=None):
-    progress_bar = tqdm.tqdm(total=len(records))
-    progress_bar.set_description('Adding new {}'.format(name))
-    for record in records:
-        progress_bar.update(1)
-        res = bitrix_request(add_method, params={'fields': record})
-        if callback:
-            callback(record, res)
+            failed.append(record)
+            logging.error('Could not add {}: {}'.format(name, errors.get(key)))
+
+    for key, error in errors.items():
+        if key.endswith('_contact'):
+            logging.error('Could not bind contact to the deal: {}'.format(error))
+
+    return failed
 
 
 def upload_products(to_add, to_update, to_delete):
     logging.info('Updating Bitrix products...')
+    failed_delete = []
     if Cfg.get('btx_remove_old_rows'):
-        delete_bitrix_fields(_product_remove, to_delete, 'products')
-    update_bitrix_fields(_product_update, to_update, 'products')
-    add_bitrix_fields(_product_add, to_add, 'products')
-    logging.info('Updated: {}'.format(len(to_update)))
-    logging.info('Added: {}'.format(len(to_add)))
-    logging.info('Deleted: {}'.format(len(to_delete)))
+        failed_delete = delete_bitrix_fields(_product_remove, to_delete, 'products', store=product_store)
+    failed_update = update_bitrix_fields(_product_update, to_update, 'products', store=product_store)
+    failed = add_bitrix_fields(_product_add, to_add, 'products', store=product_store)
+    logging.info('Updated: {}'.format(len(to_update) - len(failed_update)))
+    logging.info('Added: {}'.format(len(to_add) - len(failed)))
+    logging.info('Deleted: {}'.format(len(to_delete) - len(failed_delete)))
     logging.info('Note: The items above may not been delete if remove_old_rows flag is false')
+    return failed_changes(product_store, failed + failed_update, failed_delete)
 
 
 def upload_deals(to_add, to_update, to_delete):
-    get_contact_ids()
-    get_product_ids()
     logging.info('Processing Bitrix deals...')
+    failed_delete = []
     if Cfg.get('btx_remove_old_rows'):
-        delete_bitrix_fields(_deal_remove, to_delete, 'deals')
+        failed_delete = delete_bitrix_fields(_deal_remove, to_delete, 'deals', store=deal_store)
 
-    update_bitrix_fields(_deal_update, to_update, 'deals')
-    add_bitrix_fields(_deal_add, to_add, 'deals', add_contacts_to_deals)
-    logging.info('Updated: {}'.format(len(to_update)))
-    logging.info('Added: {}'.format(len(to_add)))
-    logging.info('Deleted: {}'.format(len(to_delete)))
+    failed_update = update_bitrix_fields(_deal_update, to_update, 'deals', store=deal_store)
+    failed = add_bitrix_fields(_deal_add, to_add, 'deals', deal_contact_commands, store=deal_store)
+    logging.info('Updated: {}'.format(len(to_update) - len(failed_update)))
+    logging.info('Added: {}'.format(len(to_add) - len(failed)))
+    logging.info('Deleted: {}'.format(len(to_delete) - len(failed_delete)))
     logging.info('Note: The items above may not been delete if remove_old_rows flag is false')
+    return failed_changes(deal_store, failed + failed_update, failed_delete)
 
 
 def upload_contacts(to_add, to_update, to_delete):
     logging.info('Processing Bitrix contacts...')
+    failed_delete = []
     if Cfg.get('btx_remove_old_rows'):
-        delete_bitrix_fields(_contact_remove, to_delete, 'contacts')
+        failed_delete = delete_bitrix_fields(_contact_remove, to_delete, 'contacts', store=contact_store)
 
-    update_bitrix_fields(_contact_update, to_update, 'contacts')
-    add_bitrix_fields(_contact_add, to_add, 'contacts')
-    logging.info('Updated: {}'.format(len(to_update)))
-    logging.info('Added: {}'.format(len(to_add)))
-    logging.info('Deleted: {}'.format(len(to_delete)))
+    failed_update = update_bitrix_fields(_contact_update, to_update, 'contacts', store=contact_store)
+    failed = add_bitrix_fields(_contact_add, to_add, 'contacts', store=contact_store)
+    logging.info('Updated: {}'.format(len(to_update) - len(failed_update)))
+    logging.info('Added: {}'.format(len(to_add) - len(failed)))
+    logging.info('Deleted: {}'.format(len(to_delete) - len(failed_delete)))
     logging.info('Note: The items above may not been delete if remove_old_rows flag is false')
+    return failed_changes(contact_store, failed + failed_update, failed_delete)
 
 
-def run_bitrix():
-    logging.info('Uploading bitrix data...')
-    db = MySQL(host=Cfg.get('db_host'),
-               port=int(Cfg.get('db_port')),
-               user=Cfg.get('db_user'),
-               password=Cfg.get('db_password'),
-               db=Cfg.get('db_name'))
-    db_data = get_db_data(db, Cfg.get('db_tables'), charset='utf8')
+def load_state():
+    if not os.path.exists(_state_file):
+        return {}
+
+    with open(_state_file, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state):
+    state_dir = os.path.dirname(_state_file)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+
+    with open(_state_file, 'w') as f:
+        json.dump(state, f)
+
+
+def get_client_bookings(db, client_ids=None, chunk_size=1000):
+    # the number of bookings of each client, of all the clients if client_ids is None
+    client_bookings = Counter()
+    if client_ids is None:
+        with db:
+            for row in db.read_all_rows('SELECT client_id, COUNT(*) AS bookings FROM bookings '
+                                        'WHERE client_id IS NOT NULL GROUP BY client_id'):
+                client_bookings[row['client_id']] = row['bookings']
+        return client_bookings
+
+    client_ids = [int(i) for i in client_ids]
+    with db:
+        for i in range(0, len(client_ids), chunk_size):
+            chunk = ','.join(str(_id) for _id in client_ids[i:i + chunk_size])
+            rows = db.read_all_rows('SELECT client_id, COUNT(*) AS bookings FROM bookings WHERE client_id IN ({}) '
+                                    'GROUP BY client_id'.format(chunk))
+            for row in rows:
+                client_bookings[row['client_id']] = row['bookings']
+
+    return client_bookings
+
+
+def get_deal_clients(booking_ids):
+    # the rows of deleted bookings are gone, their clients are taken from the deals
+    client_key = field_mappings.deal['client id']
+    deal_ids = deal_store.external_ids()
+    records = deal_store.load()
+    client_ids = set()
+    for booking_id in booking_ids:
+        try:
+            client_ids.add(int(records[deal_ids[int(booking_id)]][client_key]))
+        except (KeyError, ValueError, TypeError):
+            continue
+
+    return client_ids
+
+
+def get_changed_db_data(db, changes, last_run):
+    """Reads the db rows of the products, contacts and deals affected by the changes.
+
+    Besides the changed bookings, the deals of the changed clients and rentals are rebuilt, the other deals
+    of the clients with changed bookings, as their returning host value depends on the number of bookings,
+    and the deals which stage could move since last_run, as it depends on the current date.
+    Returns the rows, the deleted ids (as strings) and the booking counts of the clients.
+    """
+    changed = {}
+    deleted = {}
+    for table in ('rentals', 'clients', 'bookings'):
+        ops = changes.get(table, {})
+        changed[table] = set(_id for _id, op in ops.items() if op != 'delete')
+        deleted[table] = set(str(_id) for _id, op in ops.items() if op == 'delete')
+
+    now = datetime.now()
+    stage_until = now + timedelta(days=Cfg.get('btx_payed_status_interval') + 1)
+    with db:
+        bookings = get_rows_by_ids(db, 'bookings', 'id', changed['bookings'])
+        booking_clients = set(b['client_id'] for b in bookings if b['client_id'] is not None)
+        booking_clients |= get_deal_clients(deleted['bookings'])
+        bookings += get_rows_by_ids(db, 'bookings', 'client_id', changed['clients'] | booking_clients)
+        bookings += get_rows_by_ids(db, 'bookings', 'rental_id', changed['rentals'])
+        bookings += db.read_all_rows(
+            "SELECT * FROM bookings WHERE start_at BETWEEN '{0}' AND '{1}' OR end_at BETWEEN '{0}' AND '{2}'".format(
+                last_run.strftime(_mysql_date_format), stage_until.strftime(_mysql_date_format),
+                now.strftime(_mysql_date_format)))
+        bookings = list(dict((b['id'], b) for b in bookings).values())
+
+        client_ids = set(b['client_id'] for b in bookings if b['client_id'] is not None)
+        rental_ids = set(b['rental_id'] for b in bookings if b['rental_id'] is not None)
+        db_data = {'rentals': get_rows_by_ids(db, 'rentals', 'id', changed['rentals']),
+                   'clients': get_rows_by_ids(db, 'clients', 'id', changed['clients']),
+                   'bookings': bookings,
+                   'deal_clients': get_rows_by_ids(db, 'clients', 'id', client_ids),
+                   'deal_rentals': get_rows_by_ids(db, 'rentals', 'id', rental_ids)}
+        client_bookings = get_client_bookings(db, client_ids)
+
+    return db_data, deleted, client_bookings
+
+
+def upload_all(db):
+    # returns {table: {row id: op}} of the rows which bitrix records could not be uploaded
+    # clients and rentals are read twice, by their own upload and by the deals, bookings are streamed
+    db_data = get_db_data(db, ['clients', 'rentals'], charset='utf8')
 
     rentals = get_products_from_db(db_data)
     to_add, to_update, to_delete = prepare_products(rentals)
-    upload_products(to_add, to_update, to_delete)
+    failed = {'rentals': upload_products(to_add, to_update, to_delete)}
 
     clients = get_clients_from_db(db_data)
     to_add, to_update, to_delete = prepare_contacts(clients)
-    upload_contacts(to_add, to_update, to_delete)
+    failed['clients'] = upload_contacts(to_add, to_update, to_delete)
 
-    deals = get_deals_from_db(db_data)
+    with db:
+        client_bookings = get_client_bookings(db)
+        db_data['bookings'] = db.iter_rows('SELECT * FROM bookings', Cfg.get('db_fetch_size'), compact=True)
+        deals = get_deals_from_db(db_data, client_bookings)
     to_add, to_update, to_delete = prepare_deals(deals)
-    upload_deals(to_add, to_update, to_delete)
+    failed['bookings'] = upload_deals(to_add, to_update, to_delete)
+    return failed
+
+
+def upload_changes(db, changes, last_run):
+    # the bitrix records of unchanged rows are not rebuilt, and only the records of deleted rows are removed
+    failed = {}
+    db_data, deleted, client_bookings = get_changed_db_data(db, changes, last_run)
+    logging.info('Changed since the last run: {} rentals, {} clients, {} bookings'.format(
+        len(db_data['rentals']), len(db_data['clients']), len(db_data['bookings'])))
+
+    if db_data['rentals'] or deleted['rentals']:
+        rentals = get_products_from_db(db_data)
+        to_add, to_update, to_delete = prepare_products(rentals, removed_ids=deleted['rentals'])
+        failed['rentals'] = upload_products(to_add, to_update, to_delete)
+
+    if db_data['clients'] or deleted['clients']:
+        clients = get_clients_from_db(db_data)
+        to_add, to_update, to_delete = prepare_contacts(clients, removed_ids=deleted['clients'])
+        failed['clients'] = upload_contacts(to_add, to_update, to_delete)
+
+    if db_data['bookings'] or deleted['bookings']:
+        deal_data = {'clients': db_data['deal_clients'], 'rentals': db_data['deal_rentals'],
+                     'bookings': db_data['bookings']}
+        deals = get_deals_from_db(deal_data, client_bookings)
+
+        # the deals of unavailable bookings are removed as by the full upload
+        id_key = field_mappings.deal.get('id booking (source)')
+        removed_ids = deleted['bookings'] | (set(str(b['id']) for b in db_data['bookings']) -
+                                             set(str(deal[id_key]) for deal in deals))
+        to_add, to_update, to_delete = prepare_deals(deals, removed_ids=removed_ids)
+        failed['bookings'] = upload_deals(to_add, to_update, to_delete)
+
+    return failed
+
+
+def run_bitrix(full_sync=False):
+    logging.info('Uploading bitrix data...')
+    db = MySQL(host=Cfg.get('db_host'),
+               port=int(Cfg.get('db_port')),
+               user=Cfg.get('db_user'),
+               password=Cfg.get('db_password'),
+               db=Cfg.get('db_name'))
+
+    # the changes recorded while uploading are processed by the next run
+    run_started = datetime.now()
+    for store in (contact_store, product_store, deal_store):
+        store.reset(full_check=full_sync)
+    state = load_state()
+    with db:
+        create_changes_table(db)
+        last_change_id = get_last_change_id(db)
+        # the changes committed late with smaller ids are caught by the next run within the margin
+        changes_since = get_changes_since(db, Cfg.get('btx_changes_margin') * 60)
+
+        changes = None
+        if not full_sync and 'change_id' in state:
+            changes = get_changes(db, state['change_id'], last_change_id, state.get('changes_since'))
+            # the rows which could not be uploaded by the previous run are retried
+            for table, ops in state.get('failed', {}).items():
+                for row_id, op in ops.items():
+                    changes.setdefault(table, {}).setdefault(int(row_id), op)
+            if any(op == 'reload' for ops in changes.values() for op in ops.values()):
+                logging.info('Tables were reloaded, uploading all the data...')
+                changes = None
+
+        if changes is None:
+            failed = upload_all(db)
+        else:
+            failed = upload_changes(db, changes, datetime.strptime(state['run_at'], _mysql_date_format))
+
+    failed = {table: ops for table, ops in failed.items() if ops}
+    if failed:
+        logging.info('{} records could not be uploaded, they are retried by the next run'.format(
+            sum(len(ops) for ops in failed.values())))
+
+    save_state({'change_id': last_change_id, 'run_at': run_started.strftime(_mysql_date_format),
+                'changes_since': changes_since, 'failed': failed})
+    prune_changes(db, last_change_id, changes_since)
+    bitrix_mirror.close()
+    logging.info('Bitrix requests: {}'.format(_rate_limiter.stats()))
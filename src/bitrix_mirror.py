@@ -0,0 +1,85 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class BitrixMirror:
+    """Local SQLite copy of the bitrix records listed by the sync, one table row per record.
+
+    The records are stored as json by entity type and bitrix ID. For each entity type the last modification
+    time seen in bitrix and the time of the last full listing are kept, so the next run requests only
+    the records modified since then.
+    """
+
+    def __init__(self, path, default=None):
+        # default serializes the values json can not, e.g. the dates and decimals of the records to upload
+        self.path = path
+        self.default = default
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.conn is not None:
+            return self.conn
+
+        mirror_dir = os.path.dirname(self.path)
+        if not os.path.exists(mirror_dir):
+            os.makedirs(mirror_dir)
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS records ('
+                          'entity TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (entity, id))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS sync ('
+                          'entity TEXT PRIMARY KEY, modified_at TEXT, full_check_at REAL)')
+        self.conn.commit()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get_sync(self, entity):
+        """Returns (last modification time seen in bitrix, time of the last full listing) or (None, None)."""
+
+        with self.lock:
+            row = self.connect().execute('SELECT modified_at, full_check_at FROM sync WHERE entity = ?',
+                                         (entity,)).fetchone()
+        return row if row else (None, None)
+
+    def set_sync(self, entity, modified_at, full_check_at):
+        with self.lock:
+            conn = self.connect()
+            conn.execute('INSERT OR REPLACE INTO sync (entity, modified_at, full_check_at) VALUES (?, ?, ?)',
+                         (entity, modified_at, full_check_at))
+            conn.commit()
+
+    def load(self, entity):
+        with self.lock:
+            rows = self.connect().execute('SELECT id, data FROM records WHERE entity = ? ORDER BY CAST(id AS INTEGER)',
+                                          (entity,))
+            return OrderedDict((_id, json.loads(data)) for _id, data in rows)
+
+    def put(self, entity, records):
+        with self.lock:
+            conn = self.connect()
+            conn.executemany('INSERT OR REPLACE INTO records (entity, id, data) VALUES (?, ?, ?)',
+                             [(entity, str(r['ID']), json.dumps(r, default=self.default)) for r in records])
+            conn.commit()
+
+    def delete(self, entity, ids):
+        with self.lock:
+            conn = self.connect()
+            conn.executemany('DELETE FROM records WHERE entity = ? AND id = ?', [(entity, str(_id)) for _id in ids])
+            conn.commit()
+
+    def replace(self, entity, records):
+        # a full listing replaces all the stored records, so the ones deleted in bitrix disappear too
+        with self.lock:
+            conn = self.connect()
+            conn.execute('DELETE FROM records WHERE entity = ?', (entity,))
+            conn.executemany('INSERT INTO records (entity, id, data) VALUES (?, ?, ?)',
+                             [(entity, str(r['ID']), json.dumps(r, default=self.default)) for r in records])
+            conn.commit()
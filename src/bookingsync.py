@@ -1,17 +1,31 @@
 import json
 import os
 import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
 
 import requests
 
 from bookingsync_utils import *
-from mysql_wrapper import MySQL
+from datetime_utils import parse_native_datetime
+from rate_limiter import RateLimiter
+from schema_cache import load_schema
 from utilities import Cfg
-from utilities import find_all_dicts_in_list
-from utilities import find_dict_in_list
+from utilities import create_db_pool
+from utilities import create_http_session
+from utilities import Index
+from utilities import get_rows_by_ids
+from utilities import get_table_ids
 from utilities import is_number
+from utilities import record_changes
+from utilities import refresh_row_hashes
+from utilities import rollback_reload
 from utilities import to_float
 from utilities import to_int
 from utilities import write_data_to_db
@@ -25,14 +39,36 @@ _client_id = Cfg.get('bks_client_id')
 _client_secret = Cfg.get('bks_client_secret')
 _redirect_uri = Cfg.get('bks_redirect_uri')
 _native_date_format = '%Y-%m-%dT%H:%M:%SZ'
+_state_file = dir_path + os.sep + '..' + os.sep + Cfg.get('bks_state_file')
+
+# resources tracked by updated_since watermarks in incremental mode
+_watermark_resources = ['bookings', 'clients', 'rentals', 'bookings_fees', 'comments', 'sources']
+
+# records changed while a sync is running are requested again by the next one
+_watermark_overlap = timedelta(minutes=5)
+
+_ids_per_request = 100
+
+# all bookingsync requests, including the parallel ones, go through this limiter
+_rate_limiter = RateLimiter(Cfg.get('bks_rate_limit'))
+_session = create_http_session(Cfg.get('bks_pool_size'))
 
 with open(_json_file, 'r') as f:
     _token = json.load(f)
+_token_lock = threading.Lock()
+
 
+def update_token(expired_token=None):
+    with _token_lock:
+        # the token may be already refreshed by another thread
+        if expired_token is not None and _token['access_token'] != expired_token:
+            return
+        refresh_token()
 
-def update_token():
+
+def refresh_token():
     global _token
-    req = requests.post('https://www.bookingsync.com/oauth/token', params={'client_id': _client_id,
+    req = _session.post('https://www.bookingsync.com/oauth/token', params={'client_id': _client_id,
                                                                            'client_secret': _client_secret,
                                                                            'refresh_token': _token['refresh_token'],
                                                                            'grant_type': 'refresh_token',
@@ -44,38 +80,58 @@ def update_token():
             json.dump(_token, f, ensure_ascii=False)
 
 
-def request_data(url, params=None, rec=True):
-    headers = {'Authorization': str('Bearer ' + _token['access_token']), 'content-type': 'application/json',
-               'charset': 'UTF-8'}
+def request_data(url, params=None):
+    max_retries = Cfg.get('bks_max_retries')
+    token_refreshed = False
+    attempt = 0
+    while attempt <= max_retries:
+        token = _token['access_token']
+        headers = {'Authorization': str('Bearer ' + token), 'content-type': 'application/json', 'charset': 'UTF-8'}
 
-    req = requests.get(url, headers=headers, params=params)
-    if req.status_code == 401:
-        if rec:
-            update_token()
-            time.sleep(10)
-            return request_data(url, params, rec=False)
-        else:
-            raise Exception('401 error while requesting {}'.format(url))
-    elif req.status_code == 429:
-        # wait until request counts will be updated
-        if rec:
-            reset_time = datetime.fromtimestamp(int(req.headers['X-RateLimit-Reset']))
-            time.sleep((reset_time - datetime.now()).seconds)
-            a = request_data(url, params, rec=False)
-            return a
+        _rate_limiter.acquire()
+        try:
+            req = _session.get(url, headers=headers, params=params)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == max_retries:
+                raise
+            _rate_limiter.backoff(attempt)
+            attempt += 1
+            continue
+        _rate_limiter.update(req.headers)
+
+        if req.status_code == 401:
+            if token_refreshed:
+                raise Exception('401 error while requesting {}'.format(url))
+            # the parallel requests refresh the expired token once
+            update_token(token)
+            token_refreshed = True
+            continue
+        elif req.status_code == 429:
+            # should not happen, unless the same account is used by someone else
+            logging.warning('429 error while requesting {}, waiting for the rate limit reset'.format(url))
+            _rate_limiter.wait_for_reset(req.headers)
+        elif req.status_code >= 500:
+            _rate_limiter.backoff(attempt)
+        elif req.status_code != 200:
+            raise Exception('{} error while requesting a {}'.format(req.status_code, url))
         else:
-            raise Exception('429 error, something went wrong with rate limit handler'.format(url))
+            return json.loads(req.content.decode('utf-8'))
+        attempt += 1
 
-    elif req.status_code != 200:
-        raise Exception('{} error while requesting a {}'.format(req.status_code, url))
+    raise Exception('{} error while requesting a {}, gave up after {} retries'.format(req.status_code, url,
+                                                                                     max_retries))
 
-    return json.loads(req.content.decode('utf-8'))
 
+def iter_request(target, ids=None, fields=None, params=None, deleted_ids=None):
+    """Yields the records page by page, the next pages are prefetched in parallel.
+
+    At most bks_prefetch_pages pages are kept in memory, so the memory used does not depend on the account size.
+    """
 
-def advanced_request(target, ids=None, fields=None, params={}):
     # e.g. target is account and url will be accounts_base_url
     url_base = Cfg.get('bks_' + target + 's_base_url')
 
+    params = dict(params) if params else {}
     params['per_page'] = Cfg.get('bks_x_per_page')
     if ids:
         params['id'] = ids
@@ -83,36 +139,97 @@ def advanced_request(target, ids=None, fields=None, params={}):
         params['fields'] = fields
 
     req = request_data(url_base, params)
-    data = req[target + 's']
+    if deleted_ids is not None:
+        deleted_ids += req['meta'].get('deleted_ids', [])
+
     total = int(req['meta']['X-Total-Pages'])
+    params['per_page'] = req['meta']['X-Per-Page']
+    page_data = req[target + 's']
+    del req
+
+    for record in page_data:
+        yield record
+
     if total > 1:
-        params['per_page'] = req['meta']['X-Per-Page']
-        for i in range(2, total + 1):
-            params['page'] = i
-            data += request_data(url_base, params)[target + 's']
+        def request_page(page):
+            page_params = dict(params)
+            page_params['page'] = page
+            page_req = request_data(url_base, page_params)
+            if deleted_ids is not None:
+                deleted_ids.extend(page_req['meta'].get('deleted_ids', []))
+            return page_req[target + 's']
+
+        # do not run more parallel requests than the rate limit still allows
+        workers = max(min(Cfg.get('bks_max_workers'), total - 1, _rate_limiter.remaining), 1)
+        prefetch = max(Cfg.get('bks_prefetch_pages'), workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = iter(range(2, total + 1))
+            pending = deque(executor.submit(request_page, page) for page in islice(pages, prefetch))
+            while pending:
+                # pages are yielded in order, a new page is requested as soon as one is consumed
+                page_data = pending.popleft().result()
+                for page in islice(pages, 1):
+                    pending.append(executor.submit(request_page, page))
+
+                for record in page_data:
+                    yield record
+
+
+def advanced_request(target, ids=None, fields=None, params=None, deleted_ids=None):
+    return list(iter_request(target, ids, fields, params, deleted_ids))
+
+
+def request_by_ids(target, ids, params=None):
+    ids = sorted(set(ids))
+    data = []
+    for i in range(0, len(ids), _ids_per_request):
+        data += advanced_request(target, ids=','.join(str(_id) for _id in ids[i:i + _ids_per_request]),
+                                 params=params)
 
     return data
 
 
+def load_watermarks():
+    if not os.path.exists(_state_file):
+        return {}
+
+    with open(_state_file, 'r') as f:
+        return json.load(f)
+
+
+def save_watermarks(watermarks):
+    state_dir = os.path.dirname(_state_file)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+
+    with open(_state_file, 'w') as f:
+        json.dump(watermarks, f)
+
+
 def to_datetime(st):
     if st:
         try:
-            return datetime.strptime(st, _native_date_format)
+            return parse_native_datetime(st)
         except ValueError:
-            logging.error('Could not convert date from {} to {}'.format('st', _native_date_format))
+            logging.error('Could not convert date from {} to {}'.format(st, _native_date_format))
     return ''
 
 
-def get_bookings(bookings):
+def get_bookings(bookings, comments=None, canceled_ids=None):
     my_bookings = []
 
     t_ren = time.time()
-    sources = advanced_request('source', params={'from': '20111101', 'fields': 'id,name'})
+    sources = Index(iter_request('source', params={'from': '20111101', 'fields': 'id,name'}), 'id')
     logging.info('Obtained Sources data in {} sec'.format(time.time() - t_ren))
 
-    t_ren = time.time()
-    comments = advanced_request('booking_comment', params={'from': '20111101', 'fields': 'id,content'})
-    logging.info('Obtained Comments data in {} sec'.format(time.time() - t_ren))
+    if comments is None:
+        t_ren = time.time()
+        comments = iter_request('booking_comment', params={'from': '20111101', 'fields': 'id,content'})
+        comments = Index(comments, 'id')
+        logging.info('Obtained Comments data in {} sec'.format(time.time() - t_ren))
+    else:
+        comments = Index(comments, 'id')
 
     t_ren = time.time()
     accounts = request_data(Cfg.get('bks_accounts_base_url'), params={'fields': 'id,business_name'})
@@ -121,6 +238,8 @@ def get_bookings(bookings):
     for b in bookings:
         if b['status'] == 'Canceled':
             if (to_datetime(b['start_at']).date() - to_datetime(b['canceled_at']).date()).days > Cfg.get('btx_payed_status_interval'):
+                if canceled_ids is not None:
+                    canceled_ids.append(int(b['id']))
                 continue
 
         my_booking = {'id': int(b['id']),
@@ -168,7 +287,7 @@ def get_bookings(bookings):
                       'probability_win': None, 'source': b['links']['source'] if b['links']['source'] else 'Praguestars.com'}
 
         if my_booking['source']:
-            source = find_dict_in_list(sources, 'id', my_booking['source'])
+            source = sources.get(my_booking['source'])
             if source:
                 my_booking['source'] = source['name']
 
@@ -179,7 +298,7 @@ def get_bookings(bookings):
         # get comments
         comment_str = ''
         for comment_id in b['links']['booking_comments']:
-            comment = find_dict_in_list(comments, 'id', comment_id)
+            comment = comments.get(comment_id)
             if comment:
                 comment_str += comment['content'] + '\n'
         my_booking['comments'] = comment_str
@@ -187,10 +306,11 @@ def get_bookings(bookings):
         my_bookings.append(my_booking)
 
     # get account name
+    accounts = Index((a for a in accounts['accounts'] if len(a) > 0), 'id')
     for b in my_bookings:
-        for a in accounts['accounts']:
-            if len(a) > 0 and a['id'] == b['account_id']:
-                b['account'] = a['business_name']
+        account = accounts.get(b['account_id'])
+        if account:
+            b['account'] = account['business_name']
 
     return my_bookings
 
@@ -320,6 +440,8 @@ def add_booking_data(booking_split, booking, proportion=1):
 
 def get_bookings_splitted(bookings_fee, bookings, rentals):
     bookings_splitted = []
+    rentals = Index(rentals, 'id')
+    bookings_fee = Index(bookings_fee, 'booking_id')
 
     for bkg in bookings:
 
@@ -327,129 +449,308 @@ def get_bookings_splitted(bookings_fee, bookings, rentals):
         id_ = int(bkg['id']) * 100
 
         # find rental related to this booking
-        rental = find_dict_in_list(rentals, 'id', bkg['rental_id'])
+        rental = rentals.get(bkg['rental_id'])
 
         # find all fees related to this booking
-        fees = find_all_dicts_in_list(bookings_fee, 'booking_id', bkg['id'])
+        fees = bookings_fee.get_all(bkg['id'])
 
         start_at = bkg['start_at'].date()
         end_at = bkg['end_at'].date()
         total_days = (end_at - start_at).days
+        booking_fee_ids = ','.join([str(fee['id']) for fee in fees])
+        comment_fees = get_fees_from_comments(bkg['comments'])
 
-        if is_same_month(start_at, end_at):
-            booking_split = {'id': id_,
+        segments = split_by_month(start_at, end_at)
+        for i, (segment_start, segment_end, number_of_nights) in enumerate(segments):
+            booking_split = {'id': id_ + i,
                              'booking_id': bkg['id'],
-                             'booking_fee_ids': ','.join([str(fee['id']) for fee in fees]),
-                             'start_at': start_at,
-                             'end_at': end_at,
-                             'number_of_nights': total_days}
+                             'booking_fee_ids': booking_fee_ids,
+                             'start_at': segment_start,
+                             'end_at': segment_end,
+                             'number_of_nights': number_of_nights}
 
-            get_fees_for_splitted_booking(booking_split, fees, bkg)
-            add_booking_data(booking_split, bkg)
+            proportion = 1 if is_same_month(start_at, end_at) else number_of_nights / total_days
 
-            add_rental_data(booking_split, rental)
+            get_fees_for_splitted_booking(booking_split, fees, comment_fees, proportion)
+            add_booking_data(booking_split, bkg, proportion)
+            add_rental_data(booking_split, rental, proportion)
 
             bookings_splitted.append(booking_split)
-        else:
-            current_date = start_at
-            current_start_date = start_at
 
-            while current_date <= end_at:
-                if current_date.month != current_start_date.month:
-                    number_of_nights = (current_date - current_start_date).days
-                    booking_split = {'id': id_,
-                                     'booking_id': bkg['id'],
-                                     'booking_fee_ids': ','.join([str(fee['id']) for fee in fees]),
-                                     'start_at': current_start_date,
-                                     'end_at': current_date - a_day,
-                                     'number_of_nights': number_of_nights}
+    return bookings_splitted
 
-                    proportion = number_of_nights / total_days
 
-                    get_fees_for_splitted_booking(booking_split, fees, bkg, proportion)
+def remove_invalid_foreign_keys(data, client_ids, rental_ids, booking_ids):
+    for b in data['bookings']:
+        if b['client_id'] and b['client_id'] not in client_ids:
+            # logging.info('Invalid foreign key client_id {}'.format(b['client_id']))
+            b['client_id'] = None
 
-                    add_booking_data(booking_split, bkg, proportion)
+        if b['rental_id'] and b['rental_id'] not in rental_ids:
+            # logging.info('Invalid foreign key renal_id {}'.format(b['rental_id']))
+            b['rental_id'] = None
 
-                    add_rental_data(booking_split, rental, proportion)
+    for bf in data['bookings_fee']:
+        if bf['booking_id'] and bf['booking_id'] not in booking_ids:
+            # logging.info('Invalid foreign key booking_id {}'.format(bf['booking_id']))
+            bf['booking_id'] = None
 
-                    bookings_splitted.append(booking_split)
 
-                    current_start_date = current_date
-                    id_ += 1
+def get_all_data():
+    # the records are transformed while the next pages are being downloaded,
+    # so the raw json of a whole endpoint is never kept in memory
+    t_bfe = time.time()
+    bookings_fee = get_bookings_fee(iter_request('bookings_fee', params={'from': '20111101', 'status': 'booked,unavailable,tentative'}))
+    logging.info('Obtained Bookings fee data in {} sec'.format(time.time() - t_bfe))
 
-                # last day
-                elif current_date == end_at:
-                    number_of_nights = (current_date - current_start_date).days
-                    booking_split = {'id': id_,
-                                     'booking_id': bkg['id'],
-                                     'booking_fee_ids': ','.join([str(fee['id']) for fee in fees]),
-                                     'start_at': current_start_date,
-                                     'end_at': current_date,
-                                     'number_of_nights': number_of_nights}
+    t_bkg = time.time()
+    bookings = get_bookings(iter_request('booking', params={'from': '20111101', 'status': 'booked,unavailable,tentative', 'include_canceled': True}))
+    logging.info('Obtained Bookings data in {} sec'.format(time.time() - t_bkg))
 
-                    proportion = number_of_nights / total_days
-                    get_fees_for_splitted_booking(booking_split, fees, bkg, proportion)
+    t_cl = time.time()
+    clients = get_clients(iter_request('client', params={'from': '20111101'}))
+    logging.info('Obtained Clients data in {} sec'.format(time.time() - t_cl))
 
-                    add_booking_data(booking_split, bkg, proportion)
-                    add_rental_data(booking_split, rental, proportion)
+    t_ren = time.time()
+    rentals = get_rentals(iter_request('rental', params={'from': '20111101'}))
+    logging.info('Obtained Rentals data in {} sec'.format(time.time() - t_ren))
 
-                    bookings_splitted.append(booking_split)
-                    break
+    t_prc = time.time()
+    data = {'clients': clients,
+            'rentals': rentals,
+            'bookings': bookings,
+            'bookings_fee': bookings_fee}
 
-                current_date += a_day
+    data['bookings_split'] = get_bookings_splitted(data['bookings_fee'], data['bookings'], data['rentals'])
 
-    return bookings_splitted
+    remove_invalid_foreign_keys(data,
+                                client_ids=set(c['id'] for c in data['clients']),
+                                rental_ids=set(r['id'] for r in data['rentals']),
+                                booking_ids=set(b['id'] for b in data['bookings']))
 
+    logging.info('Processed obtained data in {} sec'.format(time.time() - t_prc))
+    return data
+
+
+def to_float_row(row):
+    # db returns DECIMAL columns as Decimal which can not be multiplied by the split proportion
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in row.items()}
+
+
+def request_failed(target, table, watermarks, obtained):
+    # the records of the table rows which could not be written by the previous sync
+    ids = set(watermarks.get('failed', {}).get(table, [])) - set(r['id'] for r in obtained)
+    return request_by_ids(target, ids) if ids else []
 
-def run_bookingsync():
-    t_total = time.time()
-    logging.info('Obtaining data from bookingsync...')
+
+def get_failed_ids(data, failed):
+    """Returns {table: ids} of the records to request again, as their rows could not be written.
+
+    The split rows are rebuilt from their bookings.
+    """
+    failed = {t: set(ids) for t, ids in failed.items() if ids}
+    split_ids = failed.pop('bookings_split', set())
+    if split_ids:
+        failed.setdefault('bookings', set()).update(
+            bs['booking_id'] for bs in data['bookings_split'] if bs['id'] in split_ids)
+
+    return {t: sorted(int(_id) for _id in ids) for t, ids in failed.items()}
+
+
+def get_changed_data(db, watermarks):
+    """Obtains records changed since the watermarks and merges them with the related db rows.
+
+    The records which could not be written by the previous sync are requested again by their ids.
+    Returns the changed data and the ids of rows to delete per table,
+    or None if the changes can not be applied incrementally.
+    """
+    deleted_sources = []
+    sources = advanced_request('source', params={'updated_since': watermarks['sources'], 'fields': 'id'},
+                               deleted_ids=deleted_sources)
+    if sources or deleted_sources:
+        # bookings keep the source name, so a renamed source affects bookings which were not changed
+        logging.info('Sources were changed since the last sync, full resync is required')
+        return None
+
+    deleted = {'clients': [], 'rentals': [], 'bookings': [], 'bookings_fee': [], 'bookings_split': []}
 
     t_bfe = time.time()
-    bookings_fee = advanced_request('bookings_fee', params={'from': '20111101', 'status': 'booked,unavailable,tentative'})
-    logging.info('Obtained Bookings fee data in {} sec'.format(time.time() - t_bfe))
+    bookings_fee = advanced_request('bookings_fee',
+                                    params={'updated_since': watermarks['bookings_fees'],
+                                            'status': 'booked,unavailable,tentative'},
+                                    deleted_ids=deleted['bookings_fee'])
+    bookings_fee += request_failed('bookings_fee', 'bookings_fee', watermarks, bookings_fee)
+    logging.info('Obtained {} changed Bookings fee in {} sec'.format(len(bookings_fee), time.time() - t_bfe))
 
     t_bkg = time.time()
-    bookings = advanced_request('booking', params={'from': '20111101', 'status': 'booked,unavailable,tentative', 'include_canceled': True})
-    logging.info('Obtained Bookings data in {} sec'.format(time.time() - t_bkg))
+    bookings = advanced_request('booking',
+                                params={'updated_since': watermarks['bookings'],
+                                        'status': 'booked,unavailable,tentative', 'include_canceled': True},
+                                deleted_ids=deleted['bookings'])
+
+    # bookings keep the comments content, so bookings with changed comments should be processed again
+    changed_comments = advanced_request('booking_comment', params={'updated_since': watermarks['comments']})
+    commented_ids = set(c['links'].get('booking') for c in changed_comments if c['links'].get('booking'))
+    commented_ids |= set(watermarks.get('failed', {}).get('bookings', []))
+    commented_ids -= set(b['id'] for b in bookings)
+    if commented_ids:
+        bookings += request_by_ids('booking', commented_ids, params={'include_canceled': True})
+    logging.info('Obtained {} changed Bookings in {} sec'.format(len(bookings), time.time() - t_bkg))
 
     t_cl = time.time()
-    clients = advanced_request('client', params={'from': '20111101'})
-    logging.info('Obtained Clients data in {} sec'.format(time.time() - t_cl))
+    clients = advanced_request('client', params={'updated_since': watermarks['clients']},
+                               deleted_ids=deleted['clients'])
+    clients += request_failed('client', 'clients', watermarks, clients)
+    logging.info('Obtained {} changed Clients in {} sec'.format(len(clients), time.time() - t_cl))
 
     t_ren = time.time()
-    rentals = advanced_request('rental', params={'from': '20111101'})
-    logging.info('Obtained Rentals data in {} sec'.format(time.time() - t_ren))
+    rentals = advanced_request('rental', params={'updated_since': watermarks['rentals']},
+                               deleted_ids=deleted['rentals'])
+    rentals += request_failed('rental', 'rentals', watermarks, rentals)
+    logging.info('Obtained {} changed Rentals in {} sec'.format(len(rentals), time.time() - t_ren))
 
     t_prc = time.time()
+    comment_ids = set(c for b in bookings for c in b['links']['booking_comments'])
+    comments = request_by_ids('booking_comment', comment_ids, params={'fields': 'id,content'})
+
     data = {'clients': get_clients(clients),
             'rentals': get_rentals(rentals),
-            'bookings': get_bookings(bookings),
+            'bookings': get_bookings(bookings, comments=comments, canceled_ids=deleted['bookings']),
             'bookings_fee': get_bookings_fee(bookings_fee)}
 
-    data['bookings_split'] = get_bookings_splitted(data['bookings_fee'], data['bookings'], data['rentals'])
+    for table in ['clients', 'rentals', 'bookings', 'bookings_fee']:
+        deleted[table] = set(int(_id) for _id in deleted[table])
 
-    for b in data['bookings']:
-        if b['client_id'] and not find_dict_in_list(data['clients'], 'id', b['client_id']):
-            # logging.info('Invalid foreign key client_id {}'.format(b['client_id']))
-            b['client_id'] = None
+    # bookings_split rows are rebuilt for every changed booking, every booking with changed or deleted fees
+    # and every booking of a changed rental, as the split rows keep the rental prices
+    changed_booking_ids = set(b['id'] for b in data['bookings'])
+    split_booking_ids = changed_booking_ids | set(f['booking_id'] for f in data['bookings_fee'] if f['booking_id'])
+    split_booking_ids |= set(f['booking_id'] for f in get_rows_by_ids(db, 'bookings_fee', 'id', deleted['bookings_fee'])
+                             if f['booking_id'])
+    split_booking_ids |= set(b['id'] for b in get_rows_by_ids(db, 'bookings', 'rental_id',
+                                                              set(r['id'] for r in data['rentals'])))
+    split_booking_ids -= deleted['bookings']
 
-        if b['rental_id'] and not find_dict_in_list(data['rentals'], 'id', b['rental_id']):
-            # logging.info('Invalid foreign key renal_id {}'.format(b['rental_id']))
-            b['rental_id'] = None
+    split_bookings = data['bookings'] + [to_float_row(b) for b in get_rows_by_ids(
+        db, 'bookings', 'id', split_booking_ids - changed_booking_ids)]
 
-    for bf in data['bookings_fee']:
-        if bf['booking_id'] and not find_dict_in_list(data['bookings'], 'id', bf['booking_id']):
-            # logging.info('Invalid foreign key booking_id {}'.format(bf['booking_id']))
-            bf['booking_id'] = None
+    split_fees = {f['id']: to_float_row(f) for f in get_rows_by_ids(db, 'bookings_fee', 'booking_id', split_booking_ids)}
+    split_fees.update((f['id'], f) for f in data['bookings_fee'])
+    split_fees = [f for f in split_fees.values() if f['id'] not in deleted['bookings_fee']]
+
+    split_rentals = {r['id']: to_float_row(r) for r in get_rows_by_ids(
+        db, 'rentals', 'id', set(b['rental_id'] for b in split_bookings if b['rental_id']))}
+    split_rentals.update((r['id'], r) for r in data['rentals'])
+
+    data['bookings_split'] = get_bookings_splitted(split_fees, split_bookings, list(split_rentals.values()))
+
+    # remove split rows which are not produced anymore, e.g. after the booking dates were changed
+    split_ids = set(bs['id'] for bs in data['bookings_split'])
+    old_splits = get_rows_by_ids(db, 'bookings_split', 'booking_id', split_booking_ids | deleted['bookings'])
+    deleted['bookings_split'] = set(bs['id'] for bs in old_splits) - split_ids
+
+    remove_invalid_foreign_keys(
+        data,
+        client_ids=(get_table_ids(db, 'clients') | set(c['id'] for c in data['clients'])) - deleted['clients'],
+        rental_ids=(get_table_ids(db, 'rentals') | set(r['id'] for r in data['rentals'])) - deleted['rentals'],
+        booking_ids=(get_table_ids(db, 'bookings') | changed_booking_ids) - deleted['bookings'])
 
     logging.info('Processed obtained data in {} sec'.format(time.time() - t_prc))
-    logging.info('Completed in {} second.'.format(time.time() - t_total))
+    return data, deleted
+
+
+def refresh_probability_win(db, package_size=1000):
+    """probability_win depends on the days left until the arrival, so it is refreshed for the bookings not synced.
+
+    The split rows keep the probability of their booking, they are updated as well.
+    """
+
+    now = datetime.now()
+    query = ("SELECT id, start_at, probability_win FROM bookings WHERE start_at IS NOT NULL "
+             "AND (start_at >= '{}' OR NOT probability_win <=> 100)".format(now.strftime('%Y-%m-%d %H:%M:%S')))
+    to_update = []
+    with db:
+        for _id, start_at, probability_win in db.iter_rows(query, Cfg.get('db_fetch_size'), as_dict=False):
+            probability = to_int(Cfg.get_interval_prob((start_at - now).days))
+            if probability != probability_win:
+                to_update.append((probability, _id))
+
+        if not to_update:
+            return
+
+        tables = [t for t in ('bookings', 'bookings_split') if t in Cfg.get('db_tables')]
+        schema = load_schema(db, Cfg.get('db_tables'),
+                             dir_path + os.sep + '..' + os.sep + Cfg.get('db_schema_cache_file'))
+        booking_ids = [_id for _, _id in to_update]
+        with db.transaction():
+            for i in range(0, len(to_update), package_size):
+                db.execute_many('UPDATE bookings SET probability_win = %s WHERE id = %s',
+                                to_update[i:i + package_size])
+                if 'bookings_split' in tables:
+                    db.execute_many('UPDATE bookings_split SET probability_win = %s WHERE booking_id = %s',
+                                    to_update[i:i + package_size])
+
+            # the rows are changed in place, so their hashes are refreshed for the next diff,
+            # and the changes are recorded so the deal probabilities are uploaded to bitrix
+            for table, column in (('bookings', 'id'), ('bookings_split', 'booking_id')):
+                if table in tables:
+                    row_ids = refresh_row_hashes(db, schema, table, column, booking_ids)
+                    record_changes(db, table, 'update', row_ids)
+
+    logging.info('probability_win is refreshed for {} bookings'.format(len(to_update)))
+
+
+def run_bookingsync(full_sync=False):
+    t_total = time.time()
+    logging.info('Obtaining data from bookingsync...')
 
-    db = MySQL(host=Cfg.get('db_host'),
-               port=int(Cfg.get('db_port')),
-               user=Cfg.get('db_user'),
-               password=Cfg.get('db_password'),
-               db=Cfg.get('db_name'))
+    # the connection is opened once and reused by all the db stages of the sync,
+    # the parallel table writers get their own connections
+    db_pool = create_db_pool(Cfg.get('db_writers') + 1)
+
+    # the watermark is taken before any request so that nothing changed during the sync is missed
+    sync_started = (datetime.utcnow() - _watermark_overlap).strftime(_native_date_format)
+    watermarks = load_watermarks()
+
+    try:
+        changes = None
+        if Cfg.get('bks_incremental_sync') and not full_sync and not Cfg.get('bks_clean_before_insert'):
+            if all(resource in watermarks for resource in _watermark_resources):
+                logging.info('Running incremental sync...')
+                with db_pool.connection() as db:
+                    changes = get_changed_data(db, watermarks)
+            else:
+                logging.info('No watermarks found, running full sync...')
 
-    write_data_to_db(db, data, Cfg.get('db_tables'))
+        if changes:
+            data, deleted_ids = changes
+        else:
+            data, deleted_ids = get_all_data(), None
+
+        logging.info('Completed in {} second.'.format(time.time() - t_total))
+
+        with db_pool.connection() as db:
+            failed = write_data_to_db(db, data, Cfg.get('db_tables'), deleted_ids=deleted_ids, db_pool=db_pool)
+            if changes:
+                refresh_probability_win(db)
+    finally:
+        db_pool.close_all()
+
+    # the watermarks are advanced anyway, the records of failed rows are requested by ids by the next sync
+    watermarks = {resource: sync_started for resource in _watermark_resources}
+    watermarks['failed'] = get_failed_ids(data, failed)
+    if watermarks['failed']:
+        logging.info('Rows which could not be written are requested again by the next sync: {}'.format(
+            ', '.join('{} {}'.format(len(ids), t) for t, ids in watermarks['failed'].items())))
+    save_watermarks(watermarks)
+    logging.info('Bookingsync requests: {}'.format(_rate_limiter.stats()))
+
+
+def rollback_last_reload():
+    # restores the tables replaced by the last clean_before_insert run
+    db_pool = create_db_pool()
+    try:
+        with db_pool.connection() as db:
+            rollback_reload(db, Cfg.get('db_tables'))
+    finally:
+        db_pool.close_all()
@@ -1,13 +1,22 @@
 import logging_setup
 import logging
+import sys
 import traceback
+from bookingsync import rollback_last_reload
 from bookingsync import run_bookingsync
 logging_setup.configure_logging('file')
 
 
 def main():
     try:
-        run_bookingsync()
+        if '--rollback' in sys.argv[1:]:
+            # restore the data replaced by the last full reload
+            rollback_last_reload()
+            logging.info("Rolled back the last reload!!!")
+            return
+
+        # pass --full to ignore the stored watermarks and resync all the data
+        run_bookingsync(full_sync='--full' in sys.argv[1:])
         logging.info("Completed bookingsync to mysql itegration!!!")
     except:
         logging.critical(traceback.format_exc())
@@ -1,3 +1,4 @@
+from datetime import date
 from datetime import timedelta
 from utilities import Cfg
 import logging
@@ -11,6 +12,33 @@ a_day = timedelta(days=1)
 def is_same_month(end, start): return start.month == end.month and start.year == end.year
 
 
+def first_day_of_next_month(day): return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+def split_by_month(start_at, end_at):
+    """Returns (start, end, number_of_nights) of each month part of the stay.
+
+    e.g. 2018-01-30 - 2018-02-02 is split to (2018-01-30, 2018-01-31, 2) and (2018-02-01, 2018-02-02, 1)
+    If the stay ends on the first day of a month the last part ends on the last day of the previous one.
+    """
+
+    if is_same_month(start_at, end_at):
+        return [(start_at, end_at, (end_at - start_at).days)]
+
+    segments = []
+    segment_start = start_at
+    while segment_start < end_at:
+        next_month = first_day_of_next_month(segment_start)
+        if next_month > end_at:
+            segments.append((segment_start, end_at, (end_at - segment_start).days))
+            break
+
+        segments.append((segment_start, next_month - a_day, (next_month - segment_start).days))
+        segment_start = next_month
+
+    return segments
+
+
 def get_fee_name(fee):
     for loc in fee['name'].keys():
         if fee['name'][loc]:
@@ -23,27 +51,46 @@ def get_fee_name(fee):
     return ''
 
 
-def get_fees_for_splitted_booking(booking_split, fees, bkg, portion=1):
-    # initialize fee fields
-    for fee_name in set(fee_names.values()):
-        booking_split[fee_name] = ''
+# fee columns of bookings_split table
+_fee_columns = set(fee_names.values())
 
+# the aliases are compiled once, the combined pattern is used to skip the comments without any of them
+_fee_patterns = [(fee_names[fee_name], re.compile('{}(.*)'.format(fee_name.replace('_', ' ').lower())))
+                 for fee_name in fee_names.keys()]
+_any_fee_pattern = re.compile('|'.join('(?:{})'.format(fee_name.replace('_', ' ').lower())
+                                       for fee_name in fee_names.keys())) if fee_names else None
+_fee_amount_pattern = re.compile('[0-9]+\.[0-9]*')
+
+
+def get_fees_from_comments(comments):
     # try to get fee info from booking comments, as some booking_fee data is not available via api
     # remove this if you can get all bookings_fee info in future
-    if bkg['comments']:
-        cmt = bkg['comments']  # .encode('ascii', 'ignore').decode('utf-8')
-        # b = False
-        for fee_name in fee_names.keys():
-            fee_info = re.search('{}(.*)'.format(fee_name.replace('_', ' ').lower()), cmt.lower())
-            if fee_info and len(fee_info.groups()) > 0:
-                fee_initial = re.search('[0-9]+\.[0-9]*', fee_info.group(1))
-                if fee_initial:
-                    # b = True
-                    booking_split[fee_names[fee_name]] = to_float(to_float(fee_initial.group(0)) * portion)
-
-        # for debugging
-        # if not b:
-        #   print(cmt.encode('ascii', 'ignore'))
+    comment_fees = {}
+    if not comments or not _any_fee_pattern:
+        return comment_fees
+
+    cmt = comments.lower()  # .encode('ascii', 'ignore').decode('utf-8')
+    if not _any_fee_pattern.search(cmt):
+        return comment_fees
+
+    for fee_column, fee_pattern in _fee_patterns:
+        fee_info = fee_pattern.search(cmt)
+        if fee_info:
+            fee_initial = _fee_amount_pattern.search(fee_info.group(1))
+            if fee_initial:
+                comment_fees[fee_column] = to_float(fee_initial.group(0))
+
+    return comment_fees
+
+
+def get_fees_for_splitted_booking(booking_split, fees, comment_fees, portion=1):
+    # initialize fee fields
+    for fee_name in _fee_columns:
+        booking_split[fee_name] = ''
+
+    # comment_fees are parsed once per booking by get_fees_from_comments
+    for fee_name, fee_price in comment_fees.items():
+        booking_split[fee_name] = to_float(fee_price * portion)
 
     # get fee info
     if fees:
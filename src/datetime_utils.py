@@ -0,0 +1,58 @@
+import timeit
+from datetime import datetime
+from functools import lru_cache
+
+native_date_format = '%Y-%m-%dT%H:%M:%SZ'
+bitrix_date_format = '%Y-%m-%dT%H:%M:%S'
+
+
+def _is_iso_datetime(st):
+    return len(st) >= 19 and st[4] == '-' and st[7] == '-' and st[10] == 'T' and st[13] == ':' and st[16] == ':'
+
+
+def _slice_datetime(st):
+    return datetime(int(st[0:4]), int(st[5:7]), int(st[8:10]), int(st[11:13]), int(st[14:16]), int(st[17:19]))
+
+
+@lru_cache(maxsize=65536)
+def parse_native_datetime(st):
+    """Parses bookingsync timestamps e.g. 2018-07-26T10:00:00Z, raises ValueError on invalid value as strptime."""
+
+    if len(st) == 20 and st[19] == 'Z' and _is_iso_datetime(st):
+        return _slice_datetime(st)
+    return datetime.strptime(st, native_date_format)
+
+
+@lru_cache(maxsize=65536)
+def parse_bitrix_datetime(st):
+    """Parses bitrix timestamps e.g. 2018-07-26T10:00:00+03:00, the offset is ignored."""
+
+    if len(st) == 25 and st[19] in '+-' and _is_iso_datetime(st):
+        return _slice_datetime(st)
+    return datetime.strptime(st[:19], bitrix_date_format)
+
+
+def benchmark(number=100000):
+    import re
+
+    native = '2018-07-26T10:00:00Z'
+    bitrix = '2018-07-26T10:00:00+03:00'
+
+    def strptime_bitrix(st):
+        tm = re.search(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}([\+-]\d{2}:\d{2})', st)
+        return datetime.strptime(st, '%Y-%m-%dT%H:%M:%S{}'.format(tm.group(1)))
+
+    cases = [('strptime native', lambda: datetime.strptime(native, native_date_format)),
+             ('sliced native', lambda: parse_native_datetime.__wrapped__(native)),
+             ('cached native', lambda: parse_native_datetime(native)),
+             ('regex + strptime bitrix', lambda: strptime_bitrix(bitrix)),
+             ('sliced bitrix', lambda: parse_bitrix_datetime.__wrapped__(bitrix)),
+             ('cached bitrix', lambda: parse_bitrix_datetime(bitrix))]
+
+    for name, func in cases:
+        elapsed = timeit.timeit(func, number=number)
+        print('{:<25} {:.3f} usec per call'.format(name, elapsed / number * 1e6))
+
+
+if __name__ == "__main__":
+    benchmark()
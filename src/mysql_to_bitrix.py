@@ -1,5 +1,6 @@
 import logging_setup
 import logging
+import sys
 import traceback
 import bitrix
 
@@ -8,7 +9,8 @@ logging_setup.configure_logging('file')
 
 def main():
     try:
-        bitrix.run_bitrix()
+        # pass --full to upload all the data instead of the rows changed since the previous run
+        bitrix.run_bitrix(full_sync='--full' in sys.argv[1:])
         logging.info('Completed mysql to bitrix integration!!!')
     except:
         logging.critical(traceback.format_exc())
@@ -1,34 +1,156 @@
 import pymysql as mysql
+import queue
+import threading
 import traceback
+from contextlib import contextmanager
+
+
+class Row(tuple):
+    """Compact table row, a tuple which values can be also accessed by column name as in a dict.
+
+    The column index is stored once in the row class created by make_row_type, not in each row.
+    """
+
+    __slots__ = ()
+    columns = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self.columns[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def get(self, key, default=None):
+        i = self.columns.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return self.columns.keys()
+
+    def values(self):
+        return iter(self)
+
+    def items(self):
+        return zip(self.columns.keys(), self)
+
+
+def make_row_type(columns):
+    return type('Row', (Row,), {'__slots__': (), 'columns': {col: i for i, col in enumerate(columns)}})
 
 
 class MySQL:
+    """MySQL connection, can be used as a context manager.
 
-    def __init__(self, host=None, port=None, user=None, password=None, db=None):
+    Nested connect/disconnect calls (or with blocks) reuse the opened connection,
+    it is closed when the outermost one exits, so several stages can share a single connection.
+    """
+
+    def __init__(self, host=None, port=None, user=None, password=None, db=None, local_infile=False):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.db = db
+        self.local_infile = local_infile
         self.conn = None
         self.cursor = None
+        self.depth = 0
+        self.transaction_depth = 0
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None and self.depth == 1:
+            self.conn.rollback()
+        self.disconnect()
 
-    def connect(self, charset='utf8'):
+    def connect(self, charset='utf8', local_infile=None):
+        self.depth += 1
+        if self.conn is not None:
+            return
+
+        if local_infile is None:
+            local_infile = self.local_infile
         try:
             self.conn = mysql.connect(host=self.host, port=self.port, user=self.user, password=self.password,
-                                      db=self.db, charset=charset, autocommit=False)
+                                      db=self.db, charset=charset, autocommit=False, local_infile=local_infile)
             # self.cursor = self.conn.cursor()
             self.cursor = self.conn.cursor(mysql.cursors.DictCursor)
         except:
+            self.depth -= 1
             raise Exception('Error occurred during SQL connection. Reason: {}'.format(traceback.format_exc()))
 
+    @contextmanager
+    def transaction(self):
+        """The outermost scope is a transaction committed on exit, the nested ones are savepoints.
+
+        On exception only the changes of the exited scope are rolled back.
+        """
+
+        savepoint = 'sp_{}'.format(self.transaction_depth) if self.transaction_depth else None
+        if savepoint:
+            self.execute('SAVEPOINT {}'.format(savepoint))
+        else:
+            self.conn.begin()
+
+        self.transaction_depth += 1
+        try:
+            yield self
+        except:
+            self.transaction_depth -= 1
+            if savepoint:
+                self.execute('ROLLBACK TO SAVEPOINT {}'.format(savepoint))
+            else:
+                self.conn.rollback()
+            raise
+
+        self.transaction_depth -= 1
+        if savepoint:
+            self.execute('RELEASE SAVEPOINT {}'.format(savepoint))
+        else:
+            self.conn.commit()
+
+    def commit(self):
+        # inside a transaction scope the changes are committed when the scope exits
+        if not self.transaction_depth:
+            self.conn.commit()
+
+    def rollback(self):
+        if not self.transaction_depth:
+            self.conn.rollback()
+
     def insert(self, query):
         try:
             self.cursor.execute(query)
-            self.conn.commit()
+            self.commit()
         except:
             raise Exception('Error occurred during insertion. Reason: {}'.format(traceback.format_exc()))
 
+    def insert_many(self, query, rows):
+        # pymysql rewrites the batch into multi-row INSERT statements not longer than cursor.max_stmt_length
+        try:
+            self.cursor.executemany(query, rows)
+            self.commit()
+        except:
+            self.rollback()
+            raise Exception('Error occurred during bulk insertion. Reason: {}'.format(traceback.format_exc()))
+
+    def execute_many(self, query, rows):
+        try:
+            self.cursor.executemany(query, rows)
+        except:
+            raise Exception('Error occurred during query execution. Reason: {}'.format(traceback.format_exc()))
+
+    def get_max_allowed_packet(self):
+        return int(self.read_row('SELECT @@max_allowed_packet AS size')['size'])
+
+    def set_max_statement_length(self, length):
+        self.cursor.max_stmt_length = length
+
     def execute(self, query):
         try:
             self.cursor.execute(query)
@@ -55,10 +177,106 @@ class MySQL:
         except:
             raise Exception('Error occurred during reading rows. Reason: {}'.format(traceback.format_exc()))
 
+    def iter_rows(self, query, fetch_size=1000, as_dict=True, compact=False):
+        """Streams the rows of the query with a server side cursor, fetch_size rows are fetched at once.
+
+        Rows are dicts, tuples if as_dict is False or Row tuples sharing one column index if compact is True.
+        No other query can be run on the connection until all the rows are read.
+        """
+
+        cursor_type = mysql.cursors.SSDictCursor if as_dict and not compact else mysql.cursors.SSCursor
+        cursor = self.conn.cursor(cursor_type)
+        try:
+            cursor.execute(query)
+            row_type = make_row_type([col[0] for col in cursor.description]) if compact else None
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row_type(row) if row_type else row
+        except GeneratorExit:
+            raise
+        except:
+            raise Exception('Error occurred during streaming rows. Reason: {}'.format(traceback.format_exc()))
+        finally:
+            cursor.close()
+
     def disconnect(self):
+        self.depth -= 1
+        if self.depth > 0:
+            return
+
+        self.depth = 0
+        self.transaction_depth = 0
         self.conn.commit()
         self.cursor.close()
         self.conn.close()
+        self.conn = None
+        self.cursor = None
+
+
+class MySQLPool:
+    """A small pool of opened MySQL connections.
+
+    The pooled connections are kept open between the stages, close_all should be called at the end.
+    """
+
+    def __init__(self, size=4, **kwargs):
+        self.size = size
+        self.kwargs = kwargs
+        self.free = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.all = []
+
+    def acquire(self):
+        try:
+            db = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if not create:
+                db = self.free.get()
+            else:
+                db = MySQL(**self.kwargs)
+                try:
+                    db.connect()
+                except:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+                self.all.append(db)
+                return db
+
+        # the connection may be closed by the server while it was idle
+        db.conn.ping(reconnect=True)
+        return db
+
+    def release(self, db):
+        self.free.put(db)
+
+    @contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        except:
+            if not db.transaction_depth:
+                db.conn.rollback()
+            raise
+        finally:
+            self.release(db)
+
+    def close_all(self):
+        for db in self.all:
+            while db.conn is not None:
+                db.disconnect()
+        self.all = []
+        self.created = 0
+        self.free = queue.LifoQueue()
 
 # db = MySQL(host="localhost", port=3306, user="root", password="3789", db="ico")
 # db.connect()
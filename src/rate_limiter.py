@@ -0,0 +1,173 @@
+import random
+import threading
+import time
+
+
+class Throttle:
+    """Exponential backoff and statistics shared by the limiters."""
+
+    def __init__(self, backoff_base=1.0, backoff_max=60.0):
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+
+        # statistics
+        self.started_at = None
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.throttled_time = 0.0
+        self.backoff_time = 0.0
+
+    def count_request(self, now, delay):
+        # is called under the lock
+        if self.started_at is None:
+            self.started_at = now
+        self.requests += 1
+        if delay > 0:
+            self.throttled += 1
+            self.throttled_time += delay
+
+    def backoff(self, attempt):
+        """Sleeps exponentially longer on each attempt, the jitter prevents parallel retries from syncing."""
+
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.5)
+        with self.lock:
+            self.retries += 1
+            self.backoff_time += delay
+        time.sleep(delay)
+
+    def stats(self):
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        rate = self.requests / elapsed if elapsed else 0
+        return '{} requests ({:.2f}/sec), {} throttled for {:.1f} sec, {} retries with {:.1f} sec of backoff'.format(
+            self.requests, rate, self.throttled, self.throttled_time, self.retries, self.backoff_time)
+
+
+class RateLimiter(Throttle):
+    """Token bucket shared by all threads requesting the same api.
+
+    The bucket is synchronized with X-RateLimit-Limit/Remaining/Reset headers of every response.
+    Requests go out freely while there are plenty of tokens, the last ones are spread evenly
+    until the window reset, so the server limit is never exceeded.
+    """
+
+    def __init__(self, limit, period=3600, low_water=0.1, backoff_base=1.0, backoff_max=60.0):
+        super().__init__(backoff_base, backoff_max)
+        self.limit = limit
+        self.period = period
+        self.low_water = low_water
+
+        self.remaining = limit
+        self.reset_at = time.time() + period
+        self.next_at = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            if now >= self.reset_at:
+                self.remaining = self.limit
+                self.reset_at = now + self.period
+
+            start = max(now, self.next_at)
+            if self.remaining <= 0:
+                # nothing left in this window, wait for the next one
+                start = max(start, self.reset_at)
+                self.remaining = self.limit
+                self.reset_at = start + self.period
+
+            if self.remaining <= self.limit * self.low_water:
+                self.next_at = start + (self.reset_at - start) / self.remaining
+            else:
+                self.next_at = start
+
+            self.remaining -= 1
+
+            delay = start - now
+            self.count_request(now, delay)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, headers):
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = float(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError, TypeError):
+            return
+
+        with self.lock:
+            self.limit = limit
+            if reset > self.reset_at + 1:
+                # the server has started a new window
+                self.remaining = remaining
+            else:
+                # responses of parallel requests may come out of order, keep the smallest value
+                self.remaining = min(self.remaining, remaining)
+            self.reset_at = reset
+
+    def wait_for_reset(self, headers):
+        """Is called on 429 response, blocks all the threads until the window reset."""
+
+        with self.lock:
+            self.remaining = 0
+            try:
+                self.reset_at = float(headers['X-RateLimit-Reset'])
+            except (KeyError, ValueError, TypeError):
+                pass
+            self.retries += 1
+
+        # the next acquire call waits until reset_at
+        self.acquire()
+        with self.lock:
+            self.remaining += 1
+            self.requests -= 1
+
+
+class LeakyBucket(Throttle):
+    """Leaky bucket shared by all threads requesting the same api, bitrix24 limits the requests this way.
+
+    Up to burst requests go out at once, then they are spread at rate requests per second.
+    When the server still reports the limit is exceeded, the rate is halved and then restored
+    step by step by the successful requests.
+    """
+
+    def __init__(self, rate=2.0, burst=50, min_rate=0.1, backoff_base=1.0, backoff_max=60.0):
+        super().__init__(backoff_base, backoff_max)
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+
+        self.level = 0.0
+        self.updated_at = time.time()
+        self.limit_exceeded_count = 0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.level = max(0.0, self.level - (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            # the requests over the burst wait until the bucket leaks enough
+            delay = max(0.0, (self.level + 1 - self.burst) / self.rate)
+            self.level += 1
+            self.count_request(now, delay)
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def limit_exceeded(self):
+        with self.lock:
+            self.level = max(self.level, float(self.burst))
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.limit_exceeded_count += 1
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate * 1.1)
+
+    def stats(self):
+        return '{}, {} times the limit was exceeded'.format(super().stats(), self.limit_exceeded_count)
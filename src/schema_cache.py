@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+from datetime import datetime, date
+
+_mysql_date_format = '%Y-%m-%d %H:%M:%S'
+
+
+def _is_null(value):
+    # '' and None are both written as null
+    return value is None or (isinstance(value, str) and value == '')
+
+
+def encode_value(value):
+    if _is_null(value):
+        return None
+    elif type(value) == bool:
+        return 1 if value else 0
+    return value
+
+
+def encode_datetime(value):
+    if _is_null(value):
+        return None
+    elif isinstance(value, datetime):
+        return value.strftime(_mysql_date_format)
+    return value
+
+
+def encode_date(value):
+    if _is_null(value):
+        return None
+    elif isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+def encode_flag(value):
+    if _is_null(value):
+        return None
+    try:
+        return 1 if int(value) else 0
+    except (TypeError, ValueError):
+        return value
+
+
+def decimal_encoder(scale):
+    def encode(value):
+        if _is_null(value):
+            return None
+        try:
+            return round(float(value), scale)
+        except (TypeError, ValueError):
+            return value
+
+    return encode
+
+
+def string_encoder(length):
+    def encode(value):
+        if _is_null(value):
+            return None
+        elif type(value) == bool:
+            return 1 if value else 0
+        elif isinstance(value, str) and len(value) > length:
+            logging.debug('Value is truncated to {} characters: {}'.format(length, value))
+            return value[:length]
+        return value
+
+    return encode
+
+
+def make_encoder(column):
+    data_type = column['data_type'].lower()
+    if data_type in ('datetime', 'timestamp'):
+        return encode_datetime
+    elif data_type == 'date':
+        return encode_date
+    elif data_type == 'decimal' and column['scale'] is not None:
+        return decimal_encoder(int(column['scale']))
+    elif data_type == 'tinyint' and column['column_type'].lower().startswith('tinyint(1)'):
+        return encode_flag
+    elif data_type in ('varchar', 'char') and column['max_length']:
+        return string_encoder(int(column['max_length']))
+    return encode_value
+
+
+class Schema:
+    """Columns of the synced tables with one value encoder per column chosen by its MySQL type."""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.encoders = {}
+        for table_name, columns in tables.items():
+            self.encoders[table_name] = [make_encoder(col) for col in columns]
+
+    def column_names(self, table_name):
+        return [col['name'] for col in self.tables[table_name]]
+
+    def row_encoder(self, table_name):
+        # returns a function which converts a row dict to the list of column values ready to be written
+        columns = list(zip(self.column_names(table_name), self.encoders[table_name]))
+
+        def encode(row):
+            return [enc(row.get(name)) for name, enc in columns]
+
+        return encode
+
+
+def get_schema_checksum(db, table_list):
+    # the default group_concat_max_len is too small for all the column definitions
+    db.execute('SET SESSION group_concat_max_len = 1048576')
+    row = db.read_row(
+        "SELECT MD5(GROUP_CONCAT(TABLE_NAME, ':', COLUMN_NAME, ':', COLUMN_TYPE "
+        "ORDER BY TABLE_NAME, ORDINAL_POSITION SEPARATOR ',')) AS checksum FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({})".format(
+            ','.join("'{}'".format(t) for t in table_list)))
+
+    return row['checksum']
+
+
+def read_columns(db, table_list):
+    rows = db.read_all_rows(
+        "SELECT TABLE_NAME AS table_name, COLUMN_NAME AS name, DATA_TYPE AS data_type, COLUMN_TYPE AS column_type, "
+        "CHARACTER_MAXIMUM_LENGTH AS max_length, NUMERIC_SCALE AS scale FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({}) ORDER BY TABLE_NAME, ORDINAL_POSITION".format(
+            ','.join("'{}'".format(t) for t in table_list)))
+
+    tables = {t: [] for t in table_list}
+    for row in rows:
+        tables[row['table_name']].append({'name': row['name'],
+                                          'data_type': row['data_type'],
+                                          'column_type': row['column_type'],
+                                          'max_length': None if row['max_length'] is None else int(row['max_length']),
+                                          'scale': None if row['scale'] is None else int(row['scale'])})
+
+    return tables
+
+
+def load_schema(db, table_list, cache_file):
+    """Returns the Schema of the tables, information_schema is read only if the schema checksum has changed."""
+
+    with db:
+        checksum = get_schema_checksum(db, table_list)
+
+        cache = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cache = json.load(f)
+            except ValueError:
+                logging.info('Schema cache {} is broken, reading the schema from db'.format(cache_file))
+
+        if cache and cache.get('checksum') == checksum and all(t in cache['tables'] for t in table_list):
+            return Schema({t: cache['tables'][t] for t in table_list})
+
+        logging.info('Reading the schema of {} tables'.format(', '.join(table_list)))
+        tables = read_columns(db, table_list)
+
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    with open(cache_file, 'w') as f:
+        json.dump({'checksum': checksum, 'tables': tables}, f)
+
+    return Schema(tables)
@@ -1,20 +1,35 @@
 import codecs
 import configparser
-import copy
+import hashlib
 import logging
 import os
 import re
 import sys
+import tempfile
 import time
 import traceback
-from datetime import datetime, date
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
 
 from mysql_wrapper import MySQL
+from mysql_wrapper import MySQLPool
+from schema_cache import load_schema
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(dir_path, "drivers"))
 
-_mysql_date_format = '%Y-%m-%d %H:%M:%S'
+# content hashes of the rows written by the last syncs, used to find the modified rows without reading them
+_row_hashes_table = 'sync_row_hashes'
+
+# ids of the rows written by each sync, so the next stages can process only the changed rows
+_changes_table = 'sync_changes'
+
+# full reload loads the data into <table>_new and keeps the replaced data in <table>_old
+_new_table_suffix = '_new'
+_old_table_suffix = '_old'
 
 
 class Cfg:
@@ -46,6 +61,11 @@ class Cfg:
         Cfg.config['bks_client_id'] = config_parser.get('bookingsync', 'client_id')
         Cfg.config['bks_redirect_uri'] = config_parser.get('bookingsync', 'redirect_uri')
         Cfg.config['bks_x_per_page'] = config_parser.get('bookingsync', 'x_per_page')
+        Cfg.config['bks_max_workers'] = config_parser.getint('bookingsync', 'max_workers', fallback=4)
+        Cfg.config['bks_prefetch_pages'] = config_parser.getint('bookingsync', 'prefetch_pages', fallback=8)
+        Cfg.config['bks_rate_limit'] = config_parser.getint('bookingsync', 'rate_limit', fallback=1000)
+        Cfg.config['bks_max_retries'] = config_parser.getint('bookingsync', 'max_retries', fallback=5)
+        Cfg.config['bks_pool_size'] = config_parser.getint('bookingsync', 'pool_size', fallback=10)
         Cfg.config['bks_bookings_base_url'] = config_parser.get('bookingsync', 'bookings_base_url')
         Cfg.config['bks_clients_base_url'] = config_parser.get('bookingsync', 'clients_base_url')
         Cfg.config['bks_accounts_base_url'] = config_parser.get('bookingsync', 'accounts_base_url')
@@ -54,6 +74,13 @@ class Cfg:
         Cfg.config['bks_sources_base_url'] = config_parser.get('bookingsync', 'sources_base_url')
         Cfg.config['bks_booking_comments_base_url'] = config_parser.get('bookingsync', 'comments_base_url')
         Cfg.config['bks_clean_before_insert'] = config_parser.getboolean('bookingsync', 'clean_before_insert')
+        Cfg.config['db_fetch_size'] = config_parser.getint('mysql', 'fetch_size', fallback=1000)
+        Cfg.config['db_schema_cache_file'] = config_parser.get('mysql', 'schema_cache_file',
+                                                              fallback='state/schema_cache.json')
+        Cfg.config['db_writers'] = config_parser.getint('mysql', 'writers', fallback=1)
+        Cfg.config['db_load_data_min_rows'] = config_parser.getint('mysql', 'load_data_min_rows', fallback=0)
+        Cfg.config['bks_incremental_sync'] = config_parser.getboolean('bookingsync', 'incremental_sync', fallback=False)
+        Cfg.config['bks_state_file'] = config_parser.get('bookingsync', 'state_file', fallback='state/bookingsync.json')
 
         Cfg.config['bks_payment_rule'] = {}
         for payment in config_parser.items('price_splitting'):
@@ -82,6 +109,19 @@ class Cfg:
         Cfg.config['btx_remove_old_rows'] = config_parser.getboolean('other', 'remove_old_rows')
         Cfg.config['btx_product_section_id'] = config_parser.getint('other', 'product_section_id')
         Cfg.config['btx_clean_before_insert'] = config_parser.getboolean('other', 'clean_before_insert')
+        Cfg.config['btx_fields_cache_file'] = config_parser.get('other', 'fields_cache_file',
+                                                                fallback='state/bitrix_fields.json')
+        Cfg.config['btx_fields_cache_ttl'] = config_parser.getint('other', 'fields_cache_ttl', fallback=24)
+        Cfg.config['btx_max_workers'] = config_parser.getint('other', 'max_workers', fallback=2)
+        Cfg.config['btx_rate_limit'] = config_parser.getfloat('other', 'rate_limit', fallback=2.0)
+        Cfg.config['btx_burst_limit'] = config_parser.getint('other', 'burst_limit', fallback=50)
+        Cfg.config['btx_max_retries'] = config_parser.getint('other', 'max_retries', fallback=5)
+        Cfg.config['btx_state_file'] = config_parser.get('other', 'state_file', fallback='state/bitrix.json')
+        Cfg.config['btx_changes_margin'] = config_parser.getint('other', 'changes_margin', fallback=60)
+        Cfg.config['btx_mirror_file'] = config_parser.get('other', 'mirror_file',
+                                                          fallback='state/bitrix_mirror.sqlite')
+        Cfg.config['btx_mirror_full_check'] = config_parser.getint('other', 'mirror_full_check', fallback=24)
+        Cfg.config['btx_pool_size'] = config_parser.getint('other', 'pool_size', fallback=10)
 
         Cfg.config['interval_prob'] = []
         is_interval_cmpl = re.compile('(\d+)\s*-\s*(\d+|inf)\s*days\s*(\d+)\%?')
@@ -123,143 +163,515 @@ class Cfg:
         return Cfg.config['fields_mapping']
 
 
+def create_http_session(pool_size):
+    # requests.Session keeps the connections alive between the calls,
+    # the adapter pool is thread safe and blocks the threads when all of its connections are busy
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+    return session
+
+
+def create_db_pool(size=1):
+    return MySQLPool(size=size,
+                     host=Cfg.get('db_host'),
+                     port=int(Cfg.get('db_port')),
+                     user=Cfg.get('db_user'),
+                     password=Cfg.get('db_password'),
+                     db=Cfg.get('db_name'),
+                     local_infile=Cfg.get('db_load_data_min_rows') > 0)
+
+
 def get_db_data(db, tables, charset='utf8'):
+    # the rows are streamed and stored as compact tuples, they are accessed by column name as dicts
     db.connect(charset=charset)
 
     db_tables = {}
 
     for table in tables:
-        db_tables[table] = list(db.read_all_rows('SELECT * FROM {}'.format(table)))
+        db_tables[table] = list(db.iter_rows('SELECT * FROM {}'.format(table), Cfg.get('db_fetch_size'),
+                                             compact=True))
 
     db.disconnect()
 
     return db_tables
 
 
-def clean_db_records(db, table_list):
-    db.connect()
-    db.execute('SET SQL_SAFE_UPDATES = 0')
-    db.execute('SET FOREIGN_KEY_CHECKS = 0')
-    for table_name in reversed(table_list):
-        db.execute('DELETE FROM {}'.format(table_name))
-    db.execute('SET FOREIGN_KEY_CHECKS = 1')
-    db.conn.commit()
-    db.disconnect()
+def get_table_ids(db, table):
+    with db:
+        return set(row[0] for row in db.iter_rows('SELECT id FROM {}'.format(table), Cfg.get('db_fetch_size'),
+                                                  as_dict=False))
 
 
-def get_col_names_by_table(db, table_list):
-    db.connect()
-    col_names = {}
-    for table_name in table_list:
-        col_names[table_name] = []
-        query = 'DESCRIBE {}'.format(table_name)
-        out = db.read_all_rows(query)
-        for i in out:
-            col_names[table_name].append(i['Field'])
+def get_rows_by_ids(db, table, column, ids, chunk_size=1000):
+    ids = [int(i) for i in ids]
+    rows = []
+    if not ids:
+        return rows
+
+    with db:
+        for i in range(0, len(ids), chunk_size):
+            chunk = ','.join(str(_id) for _id in ids[i:i + chunk_size])
+            rows += db.read_all_rows('SELECT * FROM {} WHERE {} IN ({})'.format(table, column, chunk))
+
+    return rows
 
-    db.disconnect()
-    return col_names
 
+def get_secondary_indexes(db, table_name):
+    # returns {index name: (index kind, [columns])} of all the indexes except the primary key
+    rows = db.read_all_rows(
+        "SELECT INDEX_NAME AS name, NON_UNIQUE AS non_unique, INDEX_TYPE AS type, COLUMN_NAME AS col, "
+        "SUB_PART AS sub_part FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{}' AND INDEX_NAME != 'PRIMARY' "
+        "ORDER BY INDEX_NAME, SEQ_IN_INDEX".format(table_name))
 
-def generate_initial_queries(table_list, col_names):
-    data_for_db = {}
+    indexes = OrderedDict()
+    for row in rows:
+        if row['name'] not in indexes:
+            if row['type'] == 'FULLTEXT':
+                kind = 'FULLTEXT INDEX'
+            elif int(row['non_unique']):
+                kind = 'INDEX'
+            else:
+                kind = 'UNIQUE INDEX'
+            indexes[row['name']] = (kind, [])
+        col = '`{}`'.format(row['col'])
+        if row['sub_part']:
+            col += '({})'.format(row['sub_part'])
+        indexes[row['name']][1].append(col)
+
+    return indexes
+
+
+def get_foreign_keys(db, table_name):
+    # returns [(columns, referenced table, referenced columns, on update, on delete)]
+    rows = db.read_all_rows(
+        "SELECT k.CONSTRAINT_NAME AS name, k.COLUMN_NAME AS col, k.REFERENCED_TABLE_NAME AS ref_table, "
+        "k.REFERENCED_COLUMN_NAME AS ref_col, r.UPDATE_RULE AS on_update, r.DELETE_RULE AS on_delete "
+        "FROM information_schema.KEY_COLUMN_USAGE k JOIN information_schema.REFERENTIAL_CONSTRAINTS r "
+        "ON r.CONSTRAINT_SCHEMA = k.CONSTRAINT_SCHEMA AND r.CONSTRAINT_NAME = k.CONSTRAINT_NAME "
+        "AND r.TABLE_NAME = k.TABLE_NAME "
+        "WHERE k.TABLE_SCHEMA = DATABASE() AND k.TABLE_NAME = '{}' AND k.REFERENCED_TABLE_NAME IS NOT NULL "
+        "ORDER BY k.CONSTRAINT_NAME, k.ORDINAL_POSITION".format(table_name))
+
+    keys = OrderedDict()
+    for row in rows:
+        if row['name'] not in keys:
+            keys[row['name']] = ([], row['ref_table'], [], row['on_update'], row['on_delete'])
+        keys[row['name']][0].append('`{}`'.format(row['col']))
+        keys[row['name']][2].append('`{}`'.format(row['ref_col']))
+
+    return list(keys.values())
+
+
+def reload_tables(db, dt, table_list, schema, package_size=500):
+    """Reloads the tables without touching the live ones until all the data is loaded.
+
+    The rows are loaded into empty <table>_new copies, their indexes and foreign keys are built after the load
+    and all the tables are swapped at once with a single RENAME TABLE. The replaced data is kept
+    in <table>_old until the next reload, so it can be restored with rollback_reload.
+    Returns the ids of the rows which could not be loaded.
+    """
+    load_data_min_rows = Cfg.get('db_load_data_min_rows')
+    new_tables = {t: t + _new_table_suffix for t in table_list}
+    loaded_rows = {}
+    failed = {}
+
+    with db:
+        indexes = {t: get_secondary_indexes(db, t) for t in table_list}
+        foreign_keys = {t: get_foreign_keys(db, t) for t in table_list}
+
+        db.execute('SET FOREIGN_KEY_CHECKS = 0')
+        try:
+            for t in table_list:
+                db.execute('DROP TABLE IF EXISTS {}'.format(new_tables[t]))
+                # CREATE TABLE LIKE copies the indexes but not the foreign keys
+                db.execute('CREATE TABLE {} LIKE {}'.format(new_tables[t], t))
+                if indexes[t]:
+                    db.execute('ALTER TABLE {} {}'.format(new_tables[t], ', '.join(
+                        'DROP INDEX `{}`'.format(name) for name in indexes[t])))
+
+            db.set_max_statement_length(db.get_max_allowed_packet() - 1024)
+            for t in table_list:
+                t_tbl = time.time()
+                rows = []
+                row_ids = set()
+                for row in dt[t]:
+                    row_id = int(row['id'])
+                    if row_id not in row_ids:
+                        row_ids.add(row_id)
+                        rows.append(row)
+                loaded_rows[t] = rows
+
+                columns = schema.column_names(t)
+                encode_row = schema.row_encoder(t)
+                failed[t] = None
+                if 0 < load_data_min_rows <= len(rows):
+                    try:
+                        failed[t] = load_rows(db, new_tables[t], columns, encode_row, rows)
+                    except:
+                        logging.info('LOAD DATA failed for {}, falling back to bulk insert: {}'.format(
+                            t, traceback.format_exc()))
+
+                if failed[t] is None:
+                    insert_query = generate_insert_queries([new_tables[t]], {new_tables[t]: columns})
+                    failed[t] = insert_rows(db, new_tables[t], insert_query[new_tables[t]], encode_row, rows,
+                                            package_size)
+
+                # building the indexes once is faster than updating them on each inserted row
+                alters = ['ADD {} `{}` ({})'.format(kind, name, ','.join(cols))
+                          for name, (kind, cols) in indexes[t].items()]
+                for cols, ref_table, ref_cols, on_update, on_delete in foreign_keys[t]:
+                    # the reloaded tables reference each other, RENAME TABLE moves the references with them
+                    if ref_table in new_tables:
+                        ref_table = new_tables[ref_table]
+                    alters.append('ADD FOREIGN KEY ({}) REFERENCES {} ({}) ON UPDATE {} ON DELETE {}'.format(
+                        ','.join(cols), ref_table, ','.join(ref_cols), on_update, on_delete))
+                if alters:
+                    db.execute('ALTER TABLE {} {}'.format(new_tables[t], ', '.join(alters)))
+
+                loaded = len(rows) - len(failed[t])
+                elapsed = time.time() - t_tbl
+                logging.info('{} rows loaded into {} in {:.2f} sec ({:.0f} rows/sec)'.format(
+                    loaded, new_tables[t], elapsed, loaded / elapsed if elapsed else 0))
+
+            for t in table_list:
+                db.execute('DROP TABLE IF EXISTS {}'.format(t + _old_table_suffix))
+            db.execute('RENAME TABLE {}'.format(', '.join(
+                '{0} TO {0}{1}, {0}{2} TO {0}'.format(t, _old_table_suffix, _new_table_suffix) for t in table_list)))
+        except:
+            for t in table_list:
+                db.execute('DROP TABLE IF EXISTS {}'.format(new_tables[t]))
+            raise
+        finally:
+            db.execute('SET FOREIGN_KEY_CHECKS = 1')
+
+        logging.info('Tables {} are swapped, the previous data is kept in the {} tables'.format(
+            ', '.join(table_list), _old_table_suffix))
+
+        # the hashes of failed rows are not stored, so they are inserted again by the next sync
+        with db.transaction():
+            for t in table_list:
+                encode_row = schema.row_encoder(t)
+                delete_all_row_hashes(db, t)
+                store_row_hashes(db, t, {int(row['id']): get_row_hash(encode_row(row))
+                                         for row in loaded_rows[t] if int(row['id']) not in failed[t]})
+                record_changes(db, t, 'reload', [None])
+
+    return failed
+
+
+def rollback_reload(db, table_list):
+    """Restores the data replaced by the last reload_tables, the reloaded data is moved to <table>_new."""
+    with db:
+        old_tables = set(row['name'] for row in db.read_all_rows(
+            "SELECT TABLE_NAME AS name FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"))
+        missing = [t for t in table_list if t + _old_table_suffix not in old_tables]
+        if missing:
+            raise Exception('There is no previous data of {} tables to roll back'.format(', '.join(missing)))
+
+        db.execute('SET FOREIGN_KEY_CHECKS = 0')
+        try:
+            for t in table_list:
+                db.execute('DROP TABLE IF EXISTS {}'.format(t + _new_table_suffix))
+            db.execute('RENAME TABLE {}'.format(', '.join(
+                '{0} TO {0}{2}, {0}{1} TO {0}'.format(t, _old_table_suffix, _new_table_suffix) for t in table_list)))
+        finally:
+            db.execute('SET FOREIGN_KEY_CHECKS = 1')
+
+        # the stored hashes describe the rolled back data, without them all the rows are rewritten by the next sync
+        create_changes_table(db)
+        with db.transaction():
+            for t in table_list:
+                delete_all_row_hashes(db, t)
+                record_changes(db, t, 'reload', [None])
+
+    logging.info('Tables {} are rolled back to the previous data'.format(', '.join(table_list)))
+
+
+def generate_insert_queries(table_list, col_names):
+    insert_queries = {}
     for table_name in table_list:
         columns = ','.join(col_names[table_name])
-        data_for_db[table_name] = 'insert into {} ({}) values '.format(table_name, columns)
+        placeholders = ','.join(['%s'] * len(col_names[table_name]))
+        insert_queries[table_name] = 'insert into {} ({}) values ({})'.format(table_name, columns, placeholders)
 
-    return data_for_db
+    return insert_queries
 
 
-def find_all_dicts_in_list(lst, key, value):
-    ret = []
-    for dic in lst:
-        if str(dic[key]) == str(value):
-            ret.append(dic)
+class Index:
+    """Hash table over a list of dicts keyed by one or more columns.
 
-    return ret
+    Keys are compared as strings, 12, 12.0 and '12' are the same key.
+    Several rows may share a key, get returns the first of them and get_all returns all of them.
+    """
+
+    def __init__(self, rows, columns):
+        self.columns = tuple(columns) if isinstance(columns, (list, tuple)) else (columns,)
+        self.table = {}
+        for row in rows:
+            self.table.setdefault(self.make_key([row[c] for c in self.columns]), []).append(row)
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+
+    def make_key(self, values):
+        if len(values) == 1:
+            return Index.normalize(values[0])
+        return tuple(Index.normalize(v) for v in values)
+
+    def get(self, *values):
+        rows = self.table.get(self.make_key(values))
+        return rows[0] if rows else None
+
+    def get_all(self, *values):
+        return list(self.table.get(self.make_key(values), []))
+
+    def __contains__(self, value):
+        return self.make_key(value if isinstance(value, tuple) else (value,)) in self.table
+
+
+def create_row_hashes_table(db):
+    db.execute('CREATE TABLE IF NOT EXISTS {} ('
+               'table_name VARCHAR(64) NOT NULL, '
+               'row_id BIGINT NOT NULL, '
+               'hash CHAR(32) NOT NULL, '
+               'PRIMARY KEY (table_name, row_id))'.format(_row_hashes_table))
+
+
+def get_row_hash(values):
+    # the hash of the encoded column values, i.e. of what is written to db
+    return hashlib.md5('\x1f'.join('' if value is None else str(value) for value in values).encode('utf8')).hexdigest()
+
+
+def get_row_hashes(db, table_name):
+    query = "SELECT row_id, hash FROM {} WHERE table_name = '{}'".format(_row_hashes_table, table_name)
+    return dict(db.iter_rows(query, Cfg.get('db_fetch_size'), as_dict=False))
+
+
+def store_row_hashes(db, table_name, row_hashes, package_size=1000):
+    rows = [(table_name, row_id, row_hash) for row_id, row_hash in row_hashes.items()]
+    query = 'INSERT INTO {} (table_name, row_id, hash) VALUES (%s, %s, %s) ' \
+            'ON DUPLICATE KEY UPDATE hash = VALUES(hash)'.format(_row_hashes_table)
+    for i in range(0, len(rows), package_size):
+        db.insert_many(query, rows[i:i + package_size])
+
+
+def refresh_row_hashes(db, schema, table_name, column, ids):
+    # stores the hashes of the rows updated in place by column values, returns the ids of the rows
+    encode_row = schema.row_encoder(table_name)
+    rows = get_rows_by_ids(db, table_name, column, ids)
+    store_row_hashes(db, table_name, {int(row['id']): get_row_hash(encode_row(row)) for row in rows})
+    return [row['id'] for row in rows]
+
+
+def delete_row_hashes(db, table_name, row_ids, package_size=1000):
+    row_ids = [int(row_id) for row_id in row_ids]
+    for i in range(0, len(row_ids), package_size):
+        db.execute("DELETE FROM {} WHERE table_name = '{}' AND row_id IN ({})".format(
+            _row_hashes_table, table_name, ','.join(str(row_id) for row_id in row_ids[i:i + package_size])))
+    db.commit()
+
+
+def create_changes_table(db):
+    db.execute('CREATE TABLE IF NOT EXISTS {} ('
+               'id BIGINT NOT NULL AUTO_INCREMENT, '
+               'table_name VARCHAR(64) NOT NULL, '
+               'row_id BIGINT NULL, '
+               'op VARCHAR(8) NOT NULL, '
+               'changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+               'PRIMARY KEY (id))'.format(_changes_table))
+
+
+def record_changes(db, table_name, op, row_ids, package_size=1000):
+    # op is insert, update, delete or reload, the reload is recorded once per table with null row id
+    rows = [(table_name, None if row_id is None else int(row_id), op) for row_id in row_ids]
+    query = 'INSERT INTO {} (table_name, row_id, op) VALUES (%s, %s, %s)'.format(_changes_table)
+    for i in range(0, len(rows), package_size):
+        db.insert_many(query, rows[i:i + package_size])
 
 
-def find_dict_in_list(lst, key, value):
-    for dic in lst:
-        if str(dic[key]) == str(value):
-            return dic
-    return None
+def get_last_change_id(db):
+    with db:
+        return db.read_row('SELECT COALESCE(MAX(id), 0) AS id FROM {}'.format(_changes_table))['id']
 
 
-def prepare_data_for_db(db, response_dict):
+def get_changes_since(db, margin):
+    # db time margin seconds ago, the changes recorded after it are kept by prune_changes
+    with db:
+        return str(db.read_row('SELECT NOW() - INTERVAL {} SECOND AS since'.format(int(margin)))['since'])
+
+
+def get_changes(db, after_id, up_to_id, since=None):
+    """Returns {table: {row id: op}} of the changes recorded after after_id, only the last op of a row is kept.
+
+    The ids are given when the rows are inserted, so a writer transaction committed after the previous run
+    could add smaller ids than after_id, the changes recorded after since are read again for this reason.
+    """
+    changes = {}
+    condition = 'id > {}'.format(int(after_id))
+    if since:
+        condition = "({} OR changed_at >= '{}')".format(condition, since)
+    query = 'SELECT table_name, row_id, op FROM {} WHERE {} AND id <= {} ORDER BY id'.format(
+        _changes_table, condition, int(up_to_id))
+    with db:
+        for table_name, row_id, op in db.iter_rows(query, Cfg.get('db_fetch_size'), as_dict=False):
+            changes.setdefault(table_name, {})[row_id] = op
+
+    return changes
+
+
+def prune_changes(db, up_to_id, before):
+    # the processed changes are not needed anymore, the ones recorded after before are read again by the next run
+    with db:
+        db.execute("DELETE FROM {} WHERE id <= {} AND changed_at < '{}'".format(_changes_table, int(up_to_id), before))
+        db.commit()
+
+
+def delete_all_row_hashes(db, table_name):
+    db.execute("DELETE FROM {} WHERE table_name = '{}'".format(_row_hashes_table, table_name))
+    db.commit()
+
+
+def prepare_data_for_db(db, response_dict, schema, deleted_ids=None):
+    """Splits the source rows into rows to insert, update and delete.
+
+    A row is modified if the hash of its columns differs from the hash stored when it was written,
+    so only (id, hash) pairs are read from db.
+    If deleted_ids is given the source rows are treated as a partial (incremental) snapshot:
+    only the rows listed in deleted_ids[table] are removed from db, all the others are kept.
+    Returns the rows to insert, update, delete and the hashes of the new and modified rows.
+    """
     db.connect()
 
     data_to_insert = {}
     data_to_delete = {}
     data_to_update = {}
+    data_hashes = {}
 
     # filter out the data which is not updated
     for key, my_table in response_dict.items():
-        to_delete = []
         to_insert = []
         to_update = []
+        row_hashes = {}
 
-        db_table = list(db.read_all_rows('SELECT * FROM {}'.format(key)))
+        source_ids = set()
+        db_ids = get_table_ids(db, key)
+        db_hashes = get_row_hashes(db, key)
+        encode_row = schema.row_encoder(key)
         for my_row in my_table:
-            db_row = find_dict_in_list(db_table, 'id', my_row['id'])
-            if db_row:
-                for col_name, col_value in db_row.items():
-                    if col_value is None:
-                        col_value = ''
-                    if my_row[col_name] is None:
-                        my_row[col_name] = ''
-
-                    if my_row[col_name] != col_value:
-                        logging.info('from {} table {}={} source {}={}'.format(key, col_name, col_value, col_name,
-                                                                                  my_row[col_name]))
-                        to_update.append(my_row)
-                        break
-
-                db_table.remove(db_row)
-            else:
+            row_id = int(my_row['id'])
+            row_hash = get_row_hash(encode_row(my_row))
+            source_ids.add(row_id)
+
+            if row_id not in db_ids:
                 to_insert.append(my_row)
+                row_hashes[row_id] = row_hash
+            elif db_hashes.get(row_id) != row_hash:
+                # rows without stored hash, e.g. written by an older version, are rewritten once
+                logging.debug('from {} table row {} is modified'.format(key, row_id))
+                to_update.append(my_row)
+                row_hashes[row_id] = row_hash
 
         # exist in db but not in source
         # old data in db should be removed
-        for db_row in db_table:
-            to_delete.append(db_row)
+        if deleted_ids is not None:
+            removed_ids = db_ids & set(int(_id) for _id in deleted_ids.get(key, []))
+        else:
+            removed_ids = db_ids - source_ids
 
         data_to_insert[key] = to_insert
-        data_to_delete[key] = to_delete
+        data_to_delete[key] = [{'id': _id} for _id in removed_ids]
         data_to_update[key] = to_update
+        data_hashes[key] = row_hashes
+        logging.info('{} table: {} new, {} modified, {} removed rows'.format(key, len(to_insert), len(to_update),
+                                                                             len(removed_ids)))
 
     db.disconnect()
-    return data_to_insert, data_to_update, data_to_delete
+    return data_to_insert, data_to_update, data_to_delete, data_hashes
 
 
-def delete_old_rows(db, to_delete):
-    db.connect()
-    db.execute('SET SQL_SAFE_UPDATES = 0')
-    db.execute('SET FOREIGN_KEY_CHECKS = 0')
-    for table_name, table_rows in to_delete.items():
-        for row in table_rows:
-            db.execute('DELETE FROM {} WHERE id={}'.format(table_name, row['id']))
-    db.execute('SET SQL_SAFE_UPDATES = 1')
-    db.execute('SET FOREIGN_KEY_CHECKS = 1')
-    db.conn.commit()
-    db.disconnect()
+def delete_old_rows(db, to_delete, package_size=1000):
+    with db:
+        db.execute('SET SQL_SAFE_UPDATES = 0')
+        db.execute('SET FOREIGN_KEY_CHECKS = 0')
+        for table_name, table_rows in to_delete.items():
+            ids = [int(row['id']) for row in table_rows]
+            with db.transaction():
+                for i in range(0, len(ids), package_size):
+                    db.execute('DELETE FROM {} WHERE id IN ({})'.format(
+                        table_name, ','.join(str(_id) for _id in ids[i:i + package_size])))
+        db.execute('SET SQL_SAFE_UPDATES = 1')
+        db.execute('SET FOREIGN_KEY_CHECKS = 1')
 
 
-def process_column_value(col):
+def to_db_value(col):
     if col == '' or col is None:
-        return 'null,'
-    elif type(col) == datetime:
-        return '"{}",'.format(str(col))
-    elif type(col) == date:
-        return '"{}",'.format(str(col))
-    elif type(col) == int or type(col) == float:
-        return '{},'.format(col)
+        return None
     elif type(col) == bool:
-        return '{},'.format('1' if col else '0')
-    elif type(col) == str:
-        return '"{}",'.format(col)
-    else:
-        assert 0
+        return 1 if col else 0
+    return col
+
+
+def to_tsv_value(col):
+    col = to_db_value(col)
+    if col is None:
+        return '\\N'
+    return str(col).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def insert_rows(db, table_name, insert_query, encode_row, rows, package_size=500):
+    # returns ids of the rows which could not be inserted
+    failed_ids = set()
+    for i in range(0, len(rows), package_size):
+        package = rows[i:i + package_size]
+        try:
+            # inside a transaction it is a savepoint, so a failed package does not roll back the others
+            with db.transaction():
+                db.execute_many(insert_query, [encode_row(row) for row in package])
+        except:
+            # insert the rows of failed package one by one to find the broken ones
+            for row in package:
+                try:
+                    with db.transaction():
+                        db.execute_many(insert_query, [encode_row(row)])
+                except:
+                    failed_ids.add(int(row['id']))
+                    logging.info('Could not insert row into {}: {}'.format(table_name, traceback.format_exc()))
+
+    return failed_ids
+
+
+def load_rows(db, table_name, columns, encode_row, rows):
+    """LOAD DATA is the fastest way to fill big tables, the rows are streamed through a temporary tsv file.
+
+    LOAD DATA LOCAL skips the duplicate rows and turns the conversion errors into warnings,
+    in that case the load is rolled back and an exception is raised, so the caller falls back to insert_rows.
+    """
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf8', newline='', suffix='.tsv', delete=False) as f:
+        for row in rows:
+            f.write('\t'.join(to_tsv_value(value) for value in encode_row(row)) + '\n')
+
+    try:
+        with db.transaction():
+            db.execute("LOAD DATA LOCAL INFILE '{}' INTO TABLE {} CHARACTER SET utf8 "
+                       "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({})".format(
+                           f.name.replace('\\', '/'), table_name, ','.join(columns)))
+            loaded = db.cursor.rowcount
+            warnings = db.read_all_rows('SHOW WARNINGS')
+            if loaded != len(rows) or warnings:
+                raise Exception('{} of {} rows loaded into {}, {} warnings: {}'.format(
+                    loaded, len(rows), table_name, len(warnings), [w['Message'] for w in warnings[:5]]))
+    finally:
+        os.remove(f.name)
+
+    return set()
 
 
 def is_number(string: str):
@@ -285,72 +697,191 @@ def to_float(num, precision=2):
     return ret
 
 
-def update_modified_rows(db, to_update, column_names):
-    db.connect()
-    db.execute('SET SQL_SAFE_UPDATES = 0')
-    db.execute('SET FOREIGN_KEY_CHECKS = 0')
-    for table_name, table_rows in to_update.items():
-        for row in table_rows:
-            update_script = 'UPDATE {} SET '.format(table_name)
-            for col in column_names[table_name]:
-                if col != 'id':
-                    update_script += '''{} = {} '''.format(col, process_column_value(row[col]))
-            update_script = update_script.strip(', ') + ' WHERE {}.id = {}'.format(table_name, row['id'])
-            db.execute(update_script)
-    db.conn.commit()
-    db.execute('SET FOREIGN_KEY_CHECKS = 1')
-    db.execute('SET SQL_SAFE_UPDATES = 1')
-    db.disconnect()
+def generate_upsert_query(table_name, columns):
+    return 'INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}'.format(
+        table_name, ','.join(columns), ','.join(['%s'] * len(columns)),
+        ','.join('{0} = VALUES({0})'.format(col) for col in columns if col != 'id'))
+
+
+def update_modified_rows(db, to_update, schema, package_size=500):
+    # the modified rows are sent as multi-row upserts, each table is updated in a single transaction scope
+    with db:
+        db.set_max_statement_length(db.get_max_allowed_packet() - 1024)
+        db.execute('SET SQL_SAFE_UPDATES = 0')
+        db.execute('SET FOREIGN_KEY_CHECKS = 0')
+        for table_name, table_rows in to_update.items():
+            query = generate_upsert_query(table_name, schema.column_names(table_name))
+            encode_row = schema.row_encoder(table_name)
+            with db.transaction():
+                for i in range(0, len(table_rows), package_size):
+                    db.execute_many(query, [encode_row(row) for row in table_rows[i:i + package_size]])
+        db.execute('SET FOREIGN_KEY_CHECKS = 1')
+        db.execute('SET SQL_SAFE_UPDATES = 1')
 
 
-def write_data_to_db(db: MySQL, dt: dict, table_list: list, package_size=500):
-    logging.info('Writing db ...')
-    start_time = time.time()
+def insert_table(db, table_name, rows, schema, insert_query, package_size=500):
+    # returns ids of the rows which could not be inserted
+    t_tbl = time.time()
+    load_data_min_rows = Cfg.get('db_load_data_min_rows')
 
-    column_names = get_col_names_by_table(db, table_list=table_list)
-    initial_queries = generate_initial_queries(table_list=table_list, col_names=column_names)
+    failed_ids = None
+    if 0 < load_data_min_rows <= len(rows):
+        try:
+            failed_ids = load_rows(db, table_name, schema.column_names(table_name), schema.row_encoder(table_name),
+                                   rows)
+        except:
+            logging.info('LOAD DATA failed for {}, falling back to bulk insert: {}'.format(
+                table_name, traceback.format_exc()))
+
+    if failed_ids is None:
+        failed_ids = insert_rows(db, table_name, insert_query, schema.row_encoder(table_name), rows, package_size)
+
+    inserted = len(rows) - len(failed_ids)
+    elapsed = time.time() - t_tbl
+    logging.info('{} rows inserted into {} in {:.2f} sec ({:.0f} rows/sec)'.format(
+        inserted, table_name, elapsed, inserted / elapsed if elapsed else 0))
+
+    return failed_ids
+
+
+def get_table_levels(db, table_list):
+    """Groups the tables by their foreign keys, the tables of a level reference only the tables of previous levels."""
+    with db:
+        parents = {}
+        for t in table_list:
+            parents[t] = set(fk[1] for fk in get_foreign_keys(db, t) if fk[1] in table_list and fk[1] != t)
+
+    levels = []
+    done = set()
+    while len(done) < len(table_list):
+        level = [t for t in table_list if t not in done and parents[t] <= done]
+        if not level:
+            # circular references, the rest of tables is written one by one in the configured order
+            levels.extend([t] for t in table_list if t not in done)
+            break
+        levels.append(level)
+        done.update(level)
+
+    return levels
+
+
+def write_table(db_pool, table_name, to_insert, to_update, row_hashes, schema, insert_query, package_size=500):
+    # writes one table on its own pooled connection in its own transaction, returns the ids of the failed rows
+    with db_pool.connection() as db:
+        with db.transaction():
+            update_modified_rows(db, {table_name: to_update}, schema)
+
+            db.set_max_statement_length(db.get_max_allowed_packet() - 1024)
+            failed_ids = insert_table(db, table_name, to_insert, schema, insert_query, package_size) \
+                if to_insert else set()
+
+            for row_id in failed_ids:
+                row_hashes.pop(row_id, None)
+            store_row_hashes(db, table_name, row_hashes)
+
+            record_changes(db, table_name, 'insert', [row['id'] for row in to_insert
+                                                      if int(row['id']) not in failed_ids])
+            record_changes(db, table_name, 'update', [row['id'] for row in to_update])
+
+    return failed_ids
+
+
+def write_changes(db, dt, table_list, schema, insert_queries, package_size=500, deleted_ids=None):
+    failed = {t: set() for t in table_list}
+    with db.transaction():
+        to_insert, to_update, to_delete, row_hashes = prepare_data_for_db(db, dt, schema, deleted_ids)
+        delete_old_rows(db, to_delete)
+        update_modified_rows(db, to_update, schema)
+
+        # leave some space for the packet header
+        db.set_max_statement_length(db.get_max_allowed_packet() - 1024)
+
+        for tbl_name in table_list:
+            rows = to_insert[tbl_name]
+            if not rows:
+                continue
+
+            failed_ids = insert_table(db, tbl_name, rows, schema, insert_queries[tbl_name], package_size)
+            failed[tbl_name] = failed_ids
+
+            # the hashes of failed rows are not stored, so they are inserted again by the next sync
+            for row_id in failed_ids:
+                row_hashes[tbl_name].pop(row_id, None)
+
+            record_changes(db, tbl_name, 'insert', [row['id'] for row in rows if int(row['id']) not in failed_ids])
+
+        for tbl_name in table_list:
+            store_row_hashes(db, tbl_name, row_hashes[tbl_name])
+            delete_row_hashes(db, tbl_name, [row['id'] for row in to_delete[tbl_name]])
+            record_changes(db, tbl_name, 'update', [row['id'] for row in to_update[tbl_name]])
+            record_changes(db, tbl_name, 'delete', [row['id'] for row in to_delete[tbl_name]])
 
-    if Cfg.get('bks_clean_before_insert'):
-        clean_db_records(db, table_list)
+    return to_insert, to_update, to_delete, failed
 
-    to_insert, to_update, to_delete = prepare_data_for_db(db, dt)
-    delete_old_rows(db, to_delete)
-    update_modified_rows(db, to_update, column_names)
 
-    db.connect()
+def write_changes_parallel(db, db_pool, dt, table_list, schema, insert_queries, package_size=500, deleted_ids=None):
+    """Writes the tables of each foreign key level in parallel, each table in its own transaction.
+
+    A level is started when all the tables it references are committed. The rows of a table which was not
+    written keep no hash, so they are written again by the next sync.
+    """
+    with db.transaction():
+        to_insert, to_update, to_delete, row_hashes = prepare_data_for_db(db, dt, schema, deleted_ids)
+        delete_old_rows(db, to_delete)
+        for tbl_name in table_list:
+            delete_row_hashes(db, tbl_name, [row['id'] for row in to_delete[tbl_name]])
+            record_changes(db, tbl_name, 'delete', [row['id'] for row in to_delete[tbl_name]])
 
-    for tbl_name in table_list:
-        table = to_insert[tbl_name]
-        data_for_db = copy.deepcopy(initial_queries[tbl_name])
-        count = 0
-        for record in table:
-            values = ''
-            for col_name in column_names[tbl_name]:
-                try:
-                    values += process_column_value(record[col_name])
-                except:
-                    logging.info(col_name)
+    failed = {}
+    levels = get_table_levels(db, table_list)
+    with ThreadPoolExecutor(max_workers=Cfg.get('db_writers')) as executor:
+        for level in levels:
+            logging.info('Writing {} tables in parallel'.format(', '.join(level)))
+            futures = [executor.submit(write_table, db_pool, t, to_insert[t], to_update[t], row_hashes[t], schema,
+                                       insert_queries[t], package_size) for t in level]
+            for t, future in zip(level, futures):
+                failed[t] = future.result()
 
-            write_query = '({})'.format(values.strip(','))
-            data_for_db += (',{}'.format(write_query) if count != 0 else write_query)
+    return to_insert, to_update, to_delete, failed
 
-            count += 1
-            if count == package_size:
-                try:
-                    db.insert(data_for_db)
-                except:
-                    logging.info(traceback.format_exc())
 
-                data_for_db = copy.deepcopy(initial_queries[tbl_name])
-                count = 0
+def write_data_to_db(db: MySQL, dt: dict, table_list: list, package_size=500, deleted_ids=None, db_pool=None):
+    """Writes all the tables through one connection in a single transaction, it is committed once at the end.
+
+    With more than one db writer and db_pool given, independent tables are written in parallel instead,
+    see write_changes_parallel. With clean_before_insert the tables are fully reloaded and swapped, see reload_tables.
+    Returns {table: ids of the rows which could not be inserted}.
+    """
 
-        if data_for_db != initial_queries[tbl_name]:
-            try:
-                db.insert(data_for_db)
-            except:
-                logging.info(traceback.format_exc())
+    logging.info('Writing db ...')
+    start_time = time.time()
+    load_data_min_rows = Cfg.get('db_load_data_min_rows')
+
+    db.connect(local_infile=load_data_min_rows > 0)
+    try:
+        # the column types are read from information_schema only when the schema has changed
+        schema = load_schema(db, table_list, dir_path + os.sep + '..' + os.sep + Cfg.get('db_schema_cache_file'))
+        column_names = {t: schema.column_names(t) for t in table_list}
+        insert_queries = generate_insert_queries(table_list=table_list, col_names=column_names)
+
+        # DDL commits implicitly, so it is done before the transaction starts
+        create_row_hashes_table(db)
+        create_changes_table(db)
+
+        if Cfg.get('bks_clean_before_insert'):
+            failed = reload_tables(db, dt, table_list, schema, package_size)
+            to_insert = {t: [row for row in dt[t] if int(row['id']) not in failed[t]] for t in table_list}
+            to_update = {t: [] for t in table_list}
+            to_delete = {t: [] for t in table_list}
+        elif db_pool is not None and Cfg.get('db_writers') > 1:
+            to_insert, to_update, to_delete, failed = write_changes_parallel(
+                db, db_pool, dt, table_list, schema, insert_queries, package_size, deleted_ids)
+        else:
+            to_insert, to_update, to_delete, failed = write_changes(db, dt, table_list, schema, insert_queries,
+                                                                    package_size, deleted_ids)
+    finally:
+        db.disconnect()
 
-    db.disconnect()
     elapsed_time = time.time() - start_time
 
     logging.info('DB write is finished in {} seconds'.format(elapsed_time))
@@ -359,4 +890,4 @@ def write_data_to_db(db: MySQL, dt: dict, table_list: list, package_size=500):
         logging.info('{} records updated: {}'.format(t, len(to_update[t])))
         logging.info('{} records deleted {}'.format(t, len(to_delete[t])))
 
-    return 0
+    return failed
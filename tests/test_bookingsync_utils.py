@@ -0,0 +1,192 @@
+import json
+import os
+import random
+import sys
+import tempfile
+import unittest
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+root_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, os.path.join(root_dir, 'src'))
+
+from utilities import Cfg
+from utilities import Index
+
+_prices = ['initial_price', 'initial_rental_price', 'charge_damage_deposit_on_arrival', 'channel_price', 'vat',
+           'city_tax', 'cleaning_fee', 'discount', 'final_rental_price', 'rental_min_price', 'rental_max_price',
+           'final_price', 'payment_left_to_collect', 'damage_deposit', 'paid_amount']
+
+# bookingsync reads these options and the token file on import, the config files are not needed for the split
+with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as token_file:
+    json.dump({'access_token': '', 'refresh_token': '', 'scope': ''}, token_file)
+Cfg.parsed = True
+Cfg.config.update({'fee_mapping': {'cleaning fee': 'cleaning_fee', 'city tax': 'city_tax', 'linen': 'linen_fee'},
+                   'bks_payment_rule': dict({p: p != 'vat' for p in _prices},
+                                            downpayment=True, min_price=False, max_price=False),
+                   'bks_token_file': os.path.relpath(token_file.name, root_dir),
+                   'bks_client_id': '', 'bks_client_secret': '', 'bks_redirect_uri': '',
+                   'bks_state_file': 'state/bookingsync.json', 'bks_rate_limit': 1000, 'bks_pool_size': 1})
+
+from bookingsync import add_booking_data
+from bookingsync import add_rental_data
+from bookingsync import get_bookings_splitted
+from bookingsync_utils import get_fees_for_splitted_booking
+from bookingsync_utils import get_fees_from_comments
+from bookingsync_utils import is_same_month
+from bookingsync_utils import split_by_month
+
+os.remove(token_file.name)
+
+a_day = timedelta(days=1)
+
+
+def split_by_days(start_at, end_at):
+    # the day by day walk split_by_month has replaced
+    if is_same_month(start_at, end_at):
+        return [(start_at, end_at, (end_at - start_at).days)]
+
+    segments = []
+    current_date = start_at
+    current_start_date = start_at
+    while current_date <= end_at:
+        if current_date.month != current_start_date.month:
+            segments.append((current_start_date, current_date - a_day, (current_date - current_start_date).days))
+            current_start_date = current_date
+        elif current_date == end_at:
+            segments.append((current_start_date, current_date, (current_date - current_start_date).days))
+            break
+        current_date += a_day
+
+    return segments
+
+
+class SplitByMonthTest(unittest.TestCase):
+
+    def assertSameSplit(self, start_at, end_at):
+        self.assertEqual(split_by_month(start_at, end_at), split_by_days(start_at, end_at),
+                         '{} - {}'.format(start_at, end_at))
+
+    def test_same_day(self):
+        self.assertSameSplit(date(2018, 7, 26), date(2018, 7, 26))
+        self.assertEqual(split_by_month(date(2018, 7, 26), date(2018, 7, 26)),
+                         [(date(2018, 7, 26), date(2018, 7, 26), 0)])
+
+    def test_same_month(self):
+        self.assertSameSplit(date(2018, 7, 1), date(2018, 7, 31))
+
+    def test_month_boundary(self):
+        self.assertSameSplit(date(2018, 1, 30), date(2018, 2, 2))
+        self.assertEqual(split_by_month(date(2018, 1, 30), date(2018, 2, 2)),
+                         [(date(2018, 1, 30), date(2018, 1, 31), 2), (date(2018, 2, 1), date(2018, 2, 2), 1)])
+
+    def test_ends_on_first_day_of_month(self):
+        self.assertSameSplit(date(2018, 1, 30), date(2018, 2, 1))
+        self.assertSameSplit(date(2018, 1, 1), date(2018, 3, 1))
+
+    def test_year_boundary(self):
+        self.assertSameSplit(date(2018, 12, 30), date(2019, 1, 2))
+        self.assertSameSplit(date(2018, 12, 31), date(2019, 1, 1))
+        self.assertSameSplit(date(2018, 11, 15), date(2019, 2, 15))
+
+    def test_leap_day(self):
+        self.assertSameSplit(date(2020, 2, 28), date(2020, 3, 1))
+        self.assertSameSplit(date(2020, 2, 29), date(2020, 3, 2))
+        self.assertSameSplit(date(2020, 2, 29), date(2020, 2, 29))
+        self.assertSameSplit(date(2019, 2, 28), date(2019, 3, 1))
+
+    def test_reversed(self):
+        self.assertSameSplit(date(2018, 2, 2), date(2018, 1, 30))
+
+    def test_random(self):
+        rnd = random.Random(2018)
+        first_day = date(2016, 1, 1)
+        for _ in range(5000):
+            start_at = first_day + timedelta(days=rnd.randint(0, 1500))
+            self.assertSameSplit(start_at, start_at + timedelta(days=rnd.randint(-5, 400)))
+
+
+
+def split_bookings_by_days(bookings_fee, bookings, rentals):
+    # get_bookings_splitted as it was before split_by_month, with the day by day walk
+    bookings_splitted = []
+    rentals = Index(rentals, 'id')
+    bookings_fee = Index(bookings_fee, 'booking_id')
+
+    for bkg in bookings:
+        id_ = int(bkg['id']) * 100
+        rental = rentals.get(bkg['rental_id'])
+        fees = bookings_fee.get_all(bkg['id'])
+        comment_fees = get_fees_from_comments(bkg['comments'])
+
+        start_at = bkg['start_at'].date()
+        end_at = bkg['end_at'].date()
+        total_days = (end_at - start_at).days
+
+        def add_split(split_start, split_end, number_of_nights, proportion):
+            booking_split = {'id': id_,
+                             'booking_id': bkg['id'],
+                             'booking_fee_ids': ','.join([str(fee['id']) for fee in fees]),
+                             'start_at': split_start,
+                             'end_at': split_end,
+                             'number_of_nights': number_of_nights}
+            get_fees_for_splitted_booking(booking_split, fees, comment_fees, proportion)
+            add_booking_data(booking_split, bkg, proportion)
+            add_rental_data(booking_split, rental, proportion)
+            bookings_splitted.append(booking_split)
+
+        if is_same_month(start_at, end_at):
+            add_split(start_at, end_at, total_days, 1)
+            continue
+
+        current_date = start_at
+        current_start_date = start_at
+        while current_date <= end_at:
+            if current_date.month != current_start_date.month:
+                number_of_nights = (current_date - current_start_date).days
+                add_split(current_start_date, current_date - a_day, number_of_nights, number_of_nights / total_days)
+                current_start_date = current_date
+                id_ += 1
+            elif current_date == end_at:
+                number_of_nights = (current_date - current_start_date).days
+                add_split(current_start_date, current_date, number_of_nights, number_of_nights / total_days)
+                break
+            current_date += a_day
+
+    return bookings_splitted
+
+
+def make_booking(booking_id, start_at, end_at, rental_id=1, comments=''):
+    booking = {'id': booking_id, 'rental_id': rental_id, 'client_id': 7, 'status': 'Booked', 'adults': 2,
+               'start_at': start_at, 'end_at': end_at, 'comments': comments, 'probability_win': 50}
+    for i, price in enumerate(_prices):
+        booking[price] = 100.0 + booking_id + i * 13.37
+    return booking
+
+
+class BookingsSplittedTest(unittest.TestCase):
+
+    def test_same_rows_as_day_walk(self):
+        bookings = [make_booking(1, datetime(2018, 7, 26, 16), datetime(2018, 7, 29, 10)),
+                    make_booking(2, datetime(2018, 1, 30, 16), datetime(2018, 2, 2, 10), comments='Cleaning fee 40.50'),
+                    make_booking(3, datetime(2018, 12, 20, 16), datetime(2019, 2, 1, 10), rental_id=2),
+                    make_booking(4, datetime(2020, 2, 29, 16), datetime(2020, 4, 3, 10),
+                                 comments='city tax 12.0, linen 9.99'),
+                    make_booking(5, datetime(2018, 5, 31, 16), datetime(2018, 6, 1, 10), rental_id=None),
+                    make_booking(6, datetime(2018, 3, 10, 16), datetime(2018, 3, 10, 18))]
+        fees = [{'id': 11, 'booking_id': 2, 'name': 'cleaning_fee', 'price': 35.0},
+                {'id': 12, 'booking_id': 3, 'name': 'city_tax', 'price': 70.7},
+                {'id': 13, 'booking_id': 3, 'name': 'linen_fee', 'price': 20.0},
+                {'id': 14, 'booking_id': 4, 'name': 'cleaning_fee', 'price': 15.25}]
+        rentals = [{'id': 1, 'downpayment': 30.0, 'min_price': 50.0, 'max_price': 150.0},
+                   {'id': 2, 'downpayment': 25.5, 'min_price': 40.0, 'max_price': 90.0}]
+
+        splits = get_bookings_splitted(fees, bookings, rentals)
+        self.assertEqual(splits, split_bookings_by_days(fees, bookings, rentals))
+        self.assertEqual([s['id'] for s in splits if s['booking_id'] == 3], [300, 301])
+        self.assertEqual([s['id'] for s in splits if s['booking_id'] == 4], [400, 401, 402])
+
+
+if __name__ == '__main__':
+    unittest.main()